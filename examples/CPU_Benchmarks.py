@@ -0,0 +1,421 @@
+"""Rough CPU benchmarks for some of the speed-related model options.
+
+Run `python ./CPU_Benchmarks.py` to run every benchmark, or
+`python ./CPU_Benchmarks.py <benchmark_name> ...` to only run some of them.
+"""
+
+import os
+import sys
+import time
+import string
+import tempfile
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from model_wrangler.model_wrangler import ModelWrangler, available_cpus
+from model_wrangler.dataset_managers import DatasetManager
+from model_wrangler.model.corral.linear_regression import LinearRegressionModel
+from model_wrangler.model.corral.logistic_regression import LogisticRegressionModel
+from model_wrangler.model.corral.dense_feedforward import DenseFeedforwardModel
+from model_wrangler.model.corral.dense_autoencoder import DenseAutoencoderModel
+from model_wrangler.model.corral.debiased_classifier import DebiasedClassifier
+from model_wrangler.model.corral.convolutional_feedforward import ConvolutionalFeedforwardModel
+from model_wrangler.model.corral.convolutional_autoencoder import ConvolutionalAutoencoderModel
+from model_wrangler.model.corral.convolutional_siamese import ConvolutionalSiameseModel
+from model_wrangler.model.corral.convolutional_triplet import ConvolutionalTripletModel
+from model_wrangler.model.corral.lstm import LstmModel
+from model_wrangler.model.corral.text_classification import TextClassificationModel
+from model_wrangler.model.corral.text_lstm import TextLstmModel
+
+
+BENCH_DIR = tempfile.mkdtemp(prefix='model_wrangler_bench_')
+
+
+def make_params(name, graph_params, **kwargs):
+    """Make a set of model params that write to a temp directory"""
+
+    params = {
+        'name': name,
+        'path': os.path.join(BENCH_DIR, name),
+        'graph': graph_params,
+    }
+    params.update(kwargs)
+    return params
+
+
+def time_training(model_class, model_params, x_data, y_data, num_steps=50):
+    """Return the number of training steps per second for a model
+    that's repeatedly fed the same batch of data"""
+
+    model = ModelWrangler(model_class, model_params)
+    data_dict = model.make_data_dict(x_data, y_data, is_training=True)
+
+    # warm-up step so that graph setup doesn't count against the model
+    model.sess.run(model.tf_mod.train_step, feed_dict=data_dict)
+
+    start = time.time()
+    for _ in range(num_steps):
+        model.sess.run(model.tf_mod.train_step, feed_dict=data_dict)
+    elapsed = time.time() - start
+
+    return num_steps / elapsed
+
+
+def in_fresh_process(func, *args, **kwargs):
+    """Run a function in a new python process and return its result. TF
+    sets some things up once per process (e.g. it reads its XLA flags and
+    makes its thread pools when the first session runs), so each setting
+    of those needs its own process to be timed fairly"""
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        return executor.submit(func, *args, **kwargs).result()
+
+
+def time_corral_model(model_name, batch_size, **kwargs):
+    """Time training of one of the `CORRAL_MODELS` on a batch of random
+    data, with extra top-level model params from `kwargs`"""
+
+    model_class, graph_params = CORRAL_MODELS[model_name]
+    name = '_'.join([model_name] + ['{}_{}'.format(*item) for item in sorted(kwargs.items())])
+    params = make_params(name, graph_params, **kwargs)
+
+    # data needs to match the placeholders the model actually built
+    model = ModelWrangler(model_class, params)
+    x_data = make_batch(model.tf_mod.inputs, batch_size)
+    y_data = make_batch(model.tf_mod.targets, batch_size)
+
+    return time_training(model_class, params, x_data, y_data)
+
+
+def count_flops(model_class, model_params):
+    """Count the float ops in a model's graph with the TF profiler. Only ops
+    with fully-known shapes get counted, so this is a relative measure"""
+
+    model = ModelWrangler(model_class, model_params)
+    profile = tf.profiler.profile(
+        model.tf_mod.graph,
+        options=tf.profiler.ProfileOptionBuilder(
+            tf.profiler.ProfileOptionBuilder.float_operation()
+        ).with_empty_output().build()
+    )
+    return profile.total_float_ops
+
+
+def print_result(name, steps_per_sec, baseline=None, units='steps/sec'):
+    """Print a benchmark result, with the speedup over a baseline"""
+
+    if baseline:
+        print('{:<40} {:>10.1f} {} ({:.2f}x)'.format(
+            name, steps_per_sec, units, steps_per_sec / baseline))
+    else:
+        print('{:<40} {:>10.1f} {}'.format(name, steps_per_sec, units))
+
+
+def make_text(batch_size, win_length):
+    """Make a batch of random strings"""
+
+    chars = np.array(list(string.ascii_letters + ' '))
+    return [
+        ''.join(np.random.choice(chars, win_length))
+        for _ in range(batch_size)
+    ]
+
+
+def make_batch(layers, batch_size, text_length=64):
+    """Make a batch of random 0/1 data (or random strings) to feed
+    into a list of model layers"""
+
+    batch = []
+    for layer in layers:
+        if layer.dtype == tf.string:
+            batch.append(make_text(batch_size, text_length))
+        else:
+            shape = [batch_size] + layer.get_shape().as_list()[1:]
+            batch.append(np.random.randint(2, size=shape).astype(float))
+    return batch
+
+
+def _dense_params(num_layers, num_units=64):
+    return [
+        {'num_units': num_units, 'activation': 'relu', 'dropout_rate': 0.1}
+        for _ in range(num_layers)
+    ]
+
+
+def _conv_params(num_layers, num_units=32):
+    return [
+        {
+            'num_units': num_units, 'kernel': 3, 'pool_size': 2,
+            'activation': 'relu', 'dropout_rate': 0.1
+        }
+        for _ in range(num_layers)
+    ]
+
+
+CORRAL_MODELS = {
+    'linear_regression': (LinearRegressionModel, {
+        'in_sizes': [256],
+        'out_sizes': [1],
+    }),
+    'logistic_regression': (LogisticRegressionModel, {
+        'in_sizes': [256],
+        'out_sizes': [1],
+    }),
+    'dense_feedforward': (DenseFeedforwardModel, {
+        'in_sizes': [256],
+        'hidden_params': _dense_params(3),
+        'embed_params': {'num_units': 16},
+        'out_sizes': [10],
+    }),
+    'dense_autoencoder': (DenseAutoencoderModel, {
+        'in_sizes': [256],
+        'encoding_params': _dense_params(2),
+        'embed_params': {'num_units': 16},
+        'decoding_params': _dense_params(2),
+    }),
+    'debiased_classifier': (DebiasedClassifier, {
+        'in_sizes': [256, 1],
+        'hidden_params': _dense_params(3),
+        'embed_params': {'num_units': 16},
+        'out_sizes': [10],
+        'debias_weight': 0.1,
+    }),
+    'convolutional_feedforward': (ConvolutionalFeedforwardModel, {
+        'in_sizes': [[256, 1]],
+        'hidden_params': _conv_params(3),
+        'embed_params': {'num_units': 16},
+        'out_sizes': [10],
+    }),
+    'convolutional_autoencoder': (ConvolutionalAutoencoderModel, {
+        'in_sizes': [[256, 1]],
+        'encoding_params': _conv_params(2),
+        'embed_params': {'num_units': 16},
+        'decoding_params': _conv_params(2),
+    }),
+    'convolutional_siamese': (ConvolutionalSiameseModel, {
+        'in_sizes': [[256, 1]],
+        'hidden_params': _conv_params(3),
+        'num_targets': 1,
+    }),
+    'convolutional_triplet': (ConvolutionalTripletModel, {
+        'in_sizes': [[256, 1]],
+        'hidden_params': _conv_params(3),
+        'num_targets': 1,
+    }),
+    'lstm': (LstmModel, {
+        'in_sizes': [[64, 1]],
+        'recurr_params': [{'units': 64, 'dropout': 0.1}, {'units': 64, 'dropout': 0.1}],
+        'out_sizes': [1],
+    }),
+    'text_classification': (TextClassificationModel, {
+        'pad_length': 64,
+        'hidden_params': _conv_params(2),
+        'embed_params': {'num_units': 16},
+        'out_sizes': [10],
+    }),
+    'text_lstm': (TextLstmModel, {
+        'win_length': 64,
+        'embed_size': 16,
+        'recurr_params': [{'units': 64, 'dropout': 0.1}, {'units': 64, 'dropout': 0.1}],
+    }),
+}
+
+
+def bench_xla_jit(batch_size=64):
+    """Compare no XLA, session-wide XLA JIT and scoped XLA JIT for
+    each of the corral models. Each one runs in its own process, since
+    session-wide XLA only compiles CPU ops if it's set up before TF runs
+    its first session"""
+
+    for model_name in sorted(CORRAL_MODELS):
+
+        baseline = None
+        for xla_jit in [None, 'session', 'scoped']:
+            steps_per_sec = in_fresh_process(
+                time_corral_model, model_name, batch_size, xla_jit=xla_jit
+            )
+            print_result('{} xla_jit={}'.format(model_name, xla_jit), steps_per_sec, baseline)
+            baseline = baseline or steps_per_sec
+
+
+def bench_fused_lstm(batch_size=64, seq_length=64):
+    """Compare the while-loop LSTM stack against LSTMBlockFusedCells"""
+
+    recurr_params = [{'units': 64, 'dropout': 0.1}, {'units': 64, 'dropout': 0.1}]
+
+    x_data = [np.random.randn(batch_size, seq_length, 1)]
+    y_data = [np.random.randn(batch_size, 1, 1)]
+
+    baseline = None
+    for fused in [False, True]:
+        params = make_params('lstm_fused_{}'.format(fused), {
+            'in_sizes': [[seq_length, 1]],
+            'recurr_params': recurr_params,
+            'out_sizes': [1],
+            'fused_lstm': fused,
+        })
+        steps_per_sec = time_training(LstmModel, params, x_data, y_data)
+        print_result('LstmModel fused_lstm={}'.format(fused), steps_per_sec, baseline)
+        baseline = baseline or steps_per_sec
+
+    x_data = [make_text(batch_size, seq_length)]
+
+    baseline = None
+    for fused in [False, True]:
+        params = make_params('text_lstm_fused_{}'.format(fused), {
+            'win_length': seq_length,
+            'embed_size': 16,
+            'recurr_params': recurr_params,
+            'fused_lstm': fused,
+        })
+        steps_per_sec = time_training(TextLstmModel, params, x_data, None)
+        print_result('TextLstmModel fused_lstm={}'.format(fused), steps_per_sec, baseline)
+        baseline = baseline or steps_per_sec
+
+
+def bench_bidir_lstm(batch_size=64, seq_length=64):
+    """Compare stack_bidirectional_dynamic_rnn against forward/backward
+    LSTMBlockFusedCells"""
+
+    x_data = [np.random.randn(batch_size, seq_length, 1)]
+    y_data = [np.random.randn(batch_size, 1, 1)]
+
+    baseline = None
+    for fused in [False, True]:
+        params = make_params('bidir_lstm_fused_{}'.format(fused), {
+            'in_sizes': [[seq_length, 1]],
+            'recurr_params': [{'units': 64, 'dropout': 0.1}, {'units': 64, 'dropout': 0.1}],
+            'out_sizes': [1],
+            'bidirectional': True,
+            'fused_lstm': fused,
+        })
+        steps_per_sec = time_training(LstmModel, params, x_data, y_data)
+        print_result('bidirectional LstmModel fused_lstm={}'.format(fused), steps_per_sec, baseline)
+        baseline = baseline or steps_per_sec
+
+
+def bench_separable_conv(batch_size=64, image_size=64, num_channels=32):
+    """Compare regular and depthwise-separable convolutions in a
+    ConvolutionalFeedforwardModel"""
+
+    x_data = [np.random.randn(batch_size, image_size, image_size, num_channels)]
+    y_data = [np.eye(10)[np.random.randint(10, size=batch_size)]]
+
+    baseline = None
+    for separable in [False, True]:
+        layer_param = {
+            'num_units': 64,
+            'kernel': [7, 7],
+            'pool_size': 2,
+            'activation': 'relu',
+            'dropout_rate': 0.1,
+            'separable': separable,
+        }
+        params = make_params('conv_separable_{}'.format(separable), {
+            'in_sizes': [[image_size, image_size, num_channels]],
+            'hidden_params': [layer_param, layer_param],
+            'embed_params': {'num_units': 10},
+            'out_sizes': [10],
+        })
+
+        flops = count_flops(ConvolutionalFeedforwardModel, params)
+        steps_per_sec = time_training(ConvolutionalFeedforwardModel, params, x_data, y_data)
+        print_result(
+            'separable={} ({:.2e} graph FLOPs)'.format(separable, flops),
+            steps_per_sec, baseline
+        )
+        baseline = baseline or steps_per_sec
+
+
+def bench_thread_sweep(batch_size=64):
+    """Sweep over intra-op/inter-op thread counts for a
+    ConvolutionalFeedforwardModel to help pick values for a machine. Each
+    point runs in its own process, since TF sizes the intra-op pool when
+    the first session in a process runs"""
+
+    num_cpus = available_cpus()
+    print('{} CPUs available'.format(num_cpus))
+
+    thread_counts = sorted({1, 2, 4, num_cpus // 4, num_cpus // 2, num_cpus} - {0})
+    thread_counts = [count for count in thread_counts if count <= num_cpus]
+
+    baseline = None
+    for intra_op_threads in thread_counts:
+        for inter_op_threads in [1, 2, 4]:
+            if inter_op_threads > num_cpus:
+                continue
+
+            steps_per_sec = in_fresh_process(
+                time_corral_model, 'convolutional_feedforward', batch_size,
+                intra_op_threads=intra_op_threads,
+                inter_op_threads=inter_op_threads
+            )
+            print_result(
+                'intra_op={} inter_op={}'.format(intra_op_threads, inter_op_threads),
+                steps_per_sec, baseline
+            )
+            baseline = baseline or steps_per_sec
+
+
+def bench_data_parallel(num_samples=50000, batch_size=64):
+    """Time a full training run of a DenseFeedforwardModel with
+    different numbers of data-parallel worker processes. This includes
+    starting the workers, so use enough data to make that small"""
+
+    model_class, graph_params = CORRAL_MODELS['dense_feedforward']
+    in_size = graph_params['in_sizes'][0]
+    out_size = graph_params['out_sizes'][0]
+
+    x_data = np.random.randn(num_samples, in_size)
+    y_data = np.random.randint(2, size=(num_samples, out_size)).astype(float)
+
+    worker_counts = [1, 2, 4, 8, 16]
+    worker_counts = [count for count in worker_counts if count <= available_cpus()]
+
+    baseline = None
+    for num_workers in worker_counts:
+        model = ModelWrangler(
+            model_class,
+            make_params('data_parallel_{}'.format(num_workers), graph_params)
+        )
+        model.add_data(
+            DatasetManager([x_data], [y_data], cache_size=num_samples),
+            DatasetManager([x_data], [y_data], cache_size=num_samples)
+        )
+        model.add_train_params({
+            'num_workers': num_workers,
+            'batch_size': batch_size,
+            'verbose': False,
+        })
+
+        start = time.time()
+        model.train()
+        samples_per_sec = num_samples / (time.time() - start)
+
+        print_result(
+            'num_workers={}'.format(num_workers), samples_per_sec, baseline,
+            units='samples/sec'
+        )
+        baseline = baseline or samples_per_sec
+
+
+BENCHMARKS = {
+    'fused_lstm': bench_fused_lstm,
+    'bidir_lstm': bench_bidir_lstm,
+    'separable_conv': bench_separable_conv,
+    'xla_jit': bench_xla_jit,
+    'thread_sweep': bench_thread_sweep,
+    'data_parallel': bench_data_parallel,
+}
+
+
+if __name__ == "__main__":
+
+    for bench_name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('\n{}'.format(bench_name))
+        BENCHMARKS[bench_name]()
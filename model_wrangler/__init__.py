@@ -1,4 +1,8 @@
 import model_wrangler.architecture
 import model_wrangler.dataset_managers
+import model_wrangler.data_parallel
+import model_wrangler.metrics_sinks
 import model_wrangler.model_wrangler
+import model_wrangler.param_search
+import model_wrangler.cross_validation
 import model_wrangler.model
@@ -4,9 +4,12 @@ import sys
 import os
 import logging
 import json
+import hashlib
+import contextlib
 
 from abc import ABC, abstractmethod
 
+import numpy as np
 import tensorflow as tf
 
 import model_wrangler.model.layers as layers
@@ -20,6 +23,36 @@ h.setFormatter(
 LOGGER.addHandler(h)
 LOGGER.setLevel(logging.DEBUG)
 
+PY_FUNC_OPS = ['PyFunc', 'PyFuncStateless', 'EagerPyFunc']
+
+
+def _handles_to_names(handles):
+    """Turn a (nested) structure of tensors and ops into one of their names"""
+
+    if handles is None:
+        return None
+    if isinstance(handles, tf.Tensor):
+        return {'tensor': handles.name}
+    if isinstance(handles, tf.Operation):
+        return {'op': handles.name}
+    if isinstance(handles, dict):
+        return {'dict': {key: _handles_to_names(val) for key, val in handles.items()}}
+    return {'list': [_handles_to_names(val) for val in handles]}
+
+
+def _names_to_handles(graph, names):
+    """Look up the tensors and ops in a structure made by `_handles_to_names`"""
+
+    if names is None:
+        return None
+    if 'tensor' in names:
+        return graph.get_tensor_by_name(names['tensor'])
+    if 'op' in names:
+        return graph.get_operation_by_name(names['op'])
+    if 'dict' in names:
+        return {key: _names_to_handles(graph, val) for key, val in names['dict'].items()}
+    return [_names_to_handles(graph, val) for val in names['list']]
+
 
 class BaseArchitecture(ABC):
     """
@@ -37,6 +70,17 @@ class BaseArchitecture(ABC):
     #
     # pylint: disable=too-many-instance-attributes
 
+    # attributes that get saved in the graph cache and re-bound by name,
+    # see `_import_cached_graph`
+    CACHED_HANDLES = [
+        'is_training', 'inputs', 'outputs', 'targets', 'embeds', 'loss',
+        'tb_scalars', 'train_step', 'accumulate_step', 'tb_stats'
+    ]
+
+    # architectures that keep python state outside of the graph handles
+    # (e.g. a `TextProcessor`) can't be rebuilt from the cache
+    GRAPH_CACHEABLE = True
+
     @abstractmethod
     def setup_layers(self, params):
         """Build all the model layers"""
@@ -78,15 +122,127 @@ class BaseArchitecture(ABC):
         learning_rate = params.get('learning_rate', 0.01)
 
         optimizer = tf.train.GradientDescentOptimizer(learning_rate)
+        train_step = self.make_train_step(optimizer, params)
+
+        return train_step
+
+    def make_train_step(self, optimizer, params, clip_value=None):
+        """Make a training step that minimizes the loss with an optimizer
+
+        If the training params have `'accumulate_steps'` > 1, gradients from
+        each micro-batch are summed into non-trainable accumulator variables by
+        `self.accumulate_step`, and the returned training step applies their
+        mean and resets the accumulators. `ModelWrangler` runs the
+        accumulate step on every batch and the training step once every
+        `accumulate_steps` batches.
+
+        For data-parallel training with more than one replica, the optimizer is
+        wrapped in a `SyncReplicasOptimizer` (stored in `self.sync_optimizer`)
+        so that each update uses the mean gradient from every worker.
+
+        Args:
+            optimizer: a tf.train optimizer
+            params: dict of training params
+            clip_value: clip each gradient to +/- this value, default = None
+
+        Returns:
+            training step op
+        """
+
+        self.accumulate_steps = params.get('accumulate_steps', 1)
+
+        global_step = None
+        if self.num_replicas > 1:
+            if self.accumulate_steps > 1:
+                raise ValueError(
+                    'Gradient accumulation is not supported in data-parallel training, '
+                    'use more workers or bigger batches instead'
+                )
+
+            optimizer = tf.train.SyncReplicasOptimizer(
+                optimizer,
+                replicas_to_aggregate=self.num_replicas,
+                total_num_replicas=self.num_replicas
+            )
+            self.sync_optimizer = optimizer
+            global_step = tf.train.get_or_create_global_step()
 
         update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         with tf.control_dependencies(update_ops):
-            train_step = optimizer.minimize(self.loss)
+            grads_and_vars = [
+                (grad, var) for grad, var in optimizer.compute_gradients(self.loss)
+                if grad is not None
+            ]
+
+            if clip_value is not None:
+                grads_and_vars = [
+                    (tf.clip_by_value(grad, -clip_value, clip_value), var)
+                    for grad, var in grads_and_vars
+                ]
+
+            if self.accumulate_steps <= 1:
+                return optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+
+        # Accumulators have to be made outside of the control dependencies,
+        # otherwise initializing them would need the update ops' inputs
+        with tf.variable_scope('grad_accumulators'):
+            accumulators = [
+                tf.get_variable(
+                    var.op.name, shape=var.get_shape(), dtype=var.dtype.base_dtype,
+                    initializer=tf.zeros_initializer(), trainable=False
+                )
+                for _, var in grads_and_vars
+            ]
+            accumulate_count = tf.get_variable(
+                'count', shape=[], dtype=tf.float32,
+                initializer=tf.zeros_initializer(), trainable=False
+            )
+
+        with tf.control_dependencies(update_ops):
+            accumulate_ops = [accumulate_count.assign_add(1.0)]
+            for accumulator, (grad, _) in zip(accumulators, grads_and_vars):
+                if isinstance(grad, tf.IndexedSlices):
+                    accumulate_ops.append(
+                        tf.scatter_add(accumulator, grad.indices, grad.values)
+                    )
+                else:
+                    accumulate_ops.append(accumulator.assign_add(grad))
+
+            self.accumulate_step = tf.group(*accumulate_ops, name='accumulate_step')
+
+        # apply the mean gradient over however many micro-batches were
+        # accumulated, then zero everything out for the next round
+        num_accumulated = tf.maximum(accumulate_count, 1.0)
+        apply_step = optimizer.apply_gradients([
+            (accumulator / num_accumulated, var)
+            for accumulator, (_, var) in zip(accumulators, grads_and_vars)
+        ])
+
+        with tf.control_dependencies([apply_step]):
+            reset_ops = [accumulate_count.assign(0.0)] + [
+                accumulator.assign(tf.zeros_like(accumulator))
+                for accumulator in accumulators
+            ]
+            train_step = tf.group(*reset_ops, name='apply_accumulated_grads')
 
         return train_step
 
     def setup_tb_stats(self, params):
-        """Set up tensorboard stats to track"""
+        """Set up tensorboard stats to track
+
+        Each phase ('training' and 'validation') gets a single writer, and
+        every scalar is written to it under its own tag. The writers queue up
+        events and write them to disk from a background thread
+
+        Args:
+            params: model params, the optional 'tensorboard' dict can have:
+                'scalars' -> list of names from `tb_scalars` to track
+                'flush_secs' -> how often to flush events to disk, default = 120
+                'max_queue' -> number of events to buffer before writing, default = 10
+
+        Returns:
+            dict of phase -> writer, and the merged summary op
+        """
 
         tb_params = params.get('tensorboard', {})
 
@@ -97,25 +253,136 @@ class BaseArchitecture(ABC):
         }
         scalar_dict.update({'loss': self.loss})
 
-        # Set up writers
-        tb_writer = {
-            'graph': tf.summary.FileWriter(params['path'], self.graph)
-        }
-
-        for phase in ['training', 'validation']:
-            tb_writer[phase] = {
-                w: tf.summary.FileWriter(os.path.join(params['path'], '_'.join([phase, w])))
-                for w in scalar_dict.keys()
-            }
+        tb_writer = self.setup_tb_writers(params)
 
         # Set up scalars
-        for name, val in scalar_dict.items():
+        tb_stats = tf.summary.merge([
             tf.summary.scalar(name, val)
-
-        tb_stats = tf.summary.merge_all()
+            for name, val in sorted(scalar_dict.items())
+        ])
 
         return tb_writer, tb_stats
 
+    def setup_tb_writers(self, params):
+        """Make a tensorboard writer for each phase, the graph only needs
+        to be written once. See `setup_tb_stats` for the params"""
+
+        tb_params = params.get('tensorboard', {})
+
+        tb_writer = {}
+        for phase in ['training', 'validation']:
+            tb_writer[phase] = tf.summary.FileWriter(
+                os.path.join(params['path'], phase),
+                graph=self.graph if phase == 'training' else None,
+                max_queue=tb_params.get('max_queue', 10),
+                flush_secs=tb_params.get('flush_secs', 120)
+            )
+
+        return tb_writer
+
+    def _graph_cache_filename(self, params):
+        """Get the filename (minus extension) for this model's cached graph,
+        based on a hash of the model class and the params used to build the
+        graph. Returns None if the graph shouldn't be cached"""
+
+        cache_dir = params.get('graph_cache', None)
+        if not cache_dir or not self.GRAPH_CACHEABLE or params.get('distributed', None):
+            return None
+
+        key_params = {
+            'model_class': '{}.{}'.format(type(self).__module__, type(self).__qualname__),
+            'tf_version': tf.__version__,
+            'graph': params.get('graph', {}),
+            'training': params.get('training', {}),
+            'tensorboard': params.get('tensorboard', {}).get('scalars', []),
+            'xla_jit': params.get('xla_jit', None),
+            # some layers build different ops when there's a GPU (e.g. the
+            # bidirectional LSTMs), so graphs can't be shared across hosts
+            'gpu': layers.gpu_available(),
+        }
+
+        # anything that isn't JSON (e.g. a function) falls back to its repr,
+        # which usually changes between runs and just misses the cache
+        key = hashlib.sha1(
+            json.dumps(key_params, sort_keys=True, default=repr).encode('utf-8')
+        ).hexdigest()
+
+        return os.path.join(cache_dir, key)
+
+    def _export_cached_graph(self, cache_filename):
+        """Save the graph and the names of the python-side handles into it"""
+
+        if any(op.type in PY_FUNC_OPS for op in self.graph.get_operations()):
+            LOGGER.info('Not caching a graph with py_funcs in it')
+            return
+
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+
+        handles = {
+            'handles': {
+                name: _handles_to_names(getattr(self, name))
+                for name in self.CACHED_HANDLES
+            },
+            'accumulate_steps': self.accumulate_steps,
+        }
+
+        # write to temp files first, so other processes building the same
+        # model never see half-written files
+        tmp_suffix = '.tmp{}'.format(os.getpid())
+        tf.train.export_meta_graph(filename=cache_filename + '.meta' + tmp_suffix, graph=self.graph)
+        with open(cache_filename + '.json' + tmp_suffix, 'w') as file:
+            json.dump(handles, file)
+
+        os.replace(cache_filename + '.meta' + tmp_suffix, cache_filename + '.meta')
+        os.replace(cache_filename + '.json' + tmp_suffix, cache_filename + '.json')
+
+    def _import_cached_graph(self, cache_filename, params):
+        """Load a cached graph into `self.graph` and re-bind the handles
+
+        Returns:
+            True if the graph was loaded from the cache
+        """
+
+        if not all(
+                os.path.exists(cache_filename + ext) for ext in ['.meta', '.json']
+        ):
+            return False
+
+        self.graph = tf.Graph()
+        try:
+            with open(cache_filename + '.json', 'r') as file:
+                handles = json.load(file)
+
+            with self.graph.as_default():
+                # there's no saver in the cached graph, so this makes a default
+                # one that we don't use, the real saver gets made in __init__
+                tf.train.import_meta_graph(cache_filename + '.meta')
+
+                for name, names in handles['handles'].items():
+                    setattr(self, name, _names_to_handles(self.graph, names))
+                self.accumulate_steps = handles['accumulate_steps']
+
+                self.tb_writer = self.setup_tb_writers(params)
+
+        except (OSError, ValueError, KeyError, tf.errors.OpError) as err:
+            LOGGER.warning('Could not load cached graph %s (%s), rebuilding it', cache_filename, err)
+            return False
+
+        LOGGER.info('Loaded cached graph %s', cache_filename)
+        self.graph_from_cache = True
+        return True
+
+    @staticmethod
+    def _jit_scope(xla_jit):
+        """Return a context manager that marks ops built inside it for XLA JIT
+        compilation if `xla_jit` is 'scoped', and does nothing otherwise. Ops
+        that XLA can't compile (e.g. `py_func`s) are left out of the clusters
+        """
+
+        if xla_jit == 'scoped':
+            return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True)
+        return contextlib.nullcontext()
+
     def __init__(self, params):
         """Initialize a tensorflow model"""
 
@@ -134,22 +401,48 @@ class BaseArchitecture(ABC):
         self.loss = None
         self.tb_scalars = None
         self.train_step = None
+        self.accumulate_step = None
+        self.accumulate_steps = 1
+        self.sync_optimizer = None
+        self.graph_from_cache = False
+
+        # Data-parallel workers put the variables on a parameter server
+        # and aggregate gradients across all the workers
+        distributed = params.get('distributed', None)
+        if distributed:
+            self.num_replicas = len(distributed['cluster']['worker'])
+            device_setter = tf.train.replica_device_setter(
+                worker_device='/job:worker/task:{}'.format(distributed['task_index']),
+                cluster=tf.train.ClusterSpec(distributed['cluster'])
+            )
+        else:
+            self.num_replicas = 1
+            device_setter = None
 
-        self.graph = tf.Graph()
-        with self.graph.as_default():
+        # reuse a graph that an identical model already built, if it's cached
+        cache_filename = self._graph_cache_filename(params)
+        if not (cache_filename and self._import_cached_graph(cache_filename, params)):
+
+            self.graph = tf.Graph()
+            with self.graph.as_default(), self.graph.device(device_setter):
 
-            self.is_training = tf.placeholder("bool", name="is_training")
+                self.is_training = tf.placeholder("bool", name="is_training")
 
-            (
-                self.inputs, self.outputs, self.targets,
-                self.embeds,
-                self.loss, self.tb_scalars
-            ) = self.setup_layers(graph_params)
+                with self._jit_scope(params.get('xla_jit', None)):
+                    (
+                        self.inputs, self.outputs, self.targets,
+                        self.embeds,
+                        self.loss, self.tb_scalars
+                    ) = self.setup_layers(graph_params)
 
-            self.train_step = self.setup_training_step(train_params)
+                    self.train_step = self.setup_training_step(train_params)
 
-            self.tb_writer, self.tb_stats = self.setup_tb_stats(params)
+                self.tb_writer, self.tb_stats = self.setup_tb_stats(params)
 
+            if cache_filename:
+                self._export_cached_graph(cache_filename)
+
+        with self.graph.as_default(), self.graph.device(device_setter):
             self.saver = tf.train.Saver(
                 name=params['name'],
                 filename=meta_filename,
@@ -163,9 +456,12 @@ class BaseTextArchitecture(BaseArchitecture):
 
     # pylint: disable=too-many-instance-attributes
 
+    GRAPH_CACHEABLE = False
+
     def __init__(self, params):
         self.text_map = None
         self.char_embeddings = None
+        self.codepoint_table = None
         super().__init__(params)
 
     def make_embedding_layer(self, embed_size=None):
@@ -194,6 +490,134 @@ class BaseTextArchitecture(BaseArchitecture):
         )
         return out_embeds
 
+    def get_codepoint_table(self):
+        """Get the constants for `TextProcessor.codepoint_table`, making them
+        the first time so that every in-graph string encoder shares them"""
+
+        if self.codepoint_table is None:
+            with tf.name_scope('codepoint_table/'):
+                self.codepoint_table = tuple(
+                    tf.constant(array, name=name)
+                    for array, name in zip(
+                        self.text_map.codepoint_table(), ['block_rows', 'splits', 'ints']
+                    )
+                )
+
+        return self.codepoint_table
+
+    def make_string_encode_layer(self, in_layer, in_graph=False, name=None):
+        """Return a layer that maps strings to left-padded ints
+
+        Args:
+            in_layer: A layer of strings
+            in_graph: boolean indicating whether to encode with native TF string
+                ops instead of a `py_func`. This doesn't hold the GIL and can be
+                exported/frozen. Non-ASCII characters get transliterated with a
+                lookup table made from `unidecode` for every code point (see
+                `TextProcessor.codepoint_table`), so both ways give the same ints
+            name: layer name
+
+        Returns:
+            a new [batch, pad_len] layer of int32 values
+        """
+
+        pad_len = self.text_map.pad_len
+
+        if not in_graph:
+            int_layer = tf.py_func(
+                self.text_map.strings_to_array, [in_layer], tf.int32, name=name
+            )
+            int_layer.set_shape(in_layer.get_shape().as_list() + [pad_len])
+            return int_layer
+
+        if pad_len is None:
+            raise ValueError('In-graph string encoding needs a `pad_len`')
+
+        # Decode the strings to code points and look up the ints that
+        # `strings_to_array` gives each one (through `unidecode`), which can
+        # be any number of ints
+        block_rows, table_splits, table_values = self.get_codepoint_table()
+
+        codepoints = tf.strings.unicode_decode(in_layer, 'UTF-8', errors='replace')
+        flat_codepoints = codepoints.flat_values
+        table_rows = (
+            tf.gather(block_rows, flat_codepoints // 256) * 256 + flat_codepoints % 256
+        )
+
+        table_idxs = tf.ragged.range(
+            tf.gather(table_splits, table_rows),
+            tf.gather(table_splits, table_rows + 1)
+        )
+        flat_ints = tf.to_int32(tf.gather(table_values, table_idxs.flat_values))
+        string_splits = tf.to_int32(tf.gather(table_idxs.row_splits, codepoints.row_splits))
+
+        # Left-pad with the pad index and keep the last `pad_len` ints of each
+        # string, reading the padding from an extra int at the end
+        offsets = (
+            tf.expand_dims(string_splits[1:] - string_splits[:-1] - pad_len, -1) +
+            tf.range(pad_len)
+        )
+        flat_ints = tf.concat([flat_ints, [self.text_map.pad_char_idx]], 0)
+        int_layer = tf.gather(
+            flat_ints,
+            tf.where(
+                offsets >= 0,
+                tf.expand_dims(string_splits[:-1], -1) + offsets,
+                tf.fill(tf.shape(offsets), tf.size(flat_ints) - 1)
+            ),
+            name=name
+        )
+        int_layer.set_shape(in_layer.get_shape().as_list() + [pad_len])
+        return int_layer
+
+    def make_string_decode_layer(self, in_layer, in_graph=False, name=None):
+        """Return a layer that maps rows of ints back to strings
+
+        Args:
+            in_layer: A [batch, len] layer of ints
+            in_graph: boolean indicating whether to decode with native TF string
+                ops instead of a `py_func`
+            name: layer name
+
+        Returns:
+            a new [batch] layer of strings
+        """
+
+        if not in_graph:
+            _func = lambda x: np.array(
+                self.text_map.ints_to_strings(x, as_bytes=True), dtype=object
+            )
+            str_layer = tf.py_func(_func, [in_layer], tf.string, name=name)
+        else:
+            char_table = tf.constant(
+                [bytes([i]) for i in self.text_map.int_to_byte],
+                name='int_to_char'
+            )
+            in_range = tf.clip_by_value(
+                tf.to_int32(in_layer), 0, len(self.text_map.int_to_byte) - 1
+            )
+            str_layer = tf.reduce_join(
+                tf.gather(char_table, in_range), axis=-1, name=name
+            )
+
+        str_layer.set_shape(in_layer.get_shape().as_list()[:1])
+        return str_layer
+
+    def make_sequence_length_layer(self, int_layer):
+        """Return a layer with the number of characters in each row of a
+        left-padded int layer, i.e. the length minus the leading padding
+
+        Args:
+            int_layer: A [batch, len] layer of ints from `make_string_encode_layer`
+
+        Returns:
+            a new [batch] layer of int32 lengths
+        """
+
+        is_pad = tf.to_int32(tf.equal(int_layer, self.text_map.pad_char_idx))
+        num_leading_pad = tf.reduce_sum(tf.cumprod(is_pad, axis=1), axis=1)
+        return tf.shape(int_layer)[1] - num_leading_pad
+
     def make_onehot_encode_layer(self, in_layer):
         """Return a layer that one-hot encodes an int layer
 
@@ -0,0 +1,106 @@
+"""Module implements parallel k-fold cross-validation for ModelWrangler models
+
+Each fold trains a fresh model in its own process with a capped number of
+threads. The folds index into the dataset manager's arrays rather than
+copying them, see `BaseDatasetManager.split_folds`.
+"""
+
+import os
+import sys
+import logging
+import multiprocessing
+
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model_wrangler.model_wrangler import ModelWrangler, available_cpus
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def _run_fold(wrangler_class, model_class, model_params, training_params,
+              training_data, holdout_data):
+    """Train a fresh model on one fold and score it on the held-out samples"""
+
+    model = wrangler_class(model_class, model_params)
+    model.add_data(training_data, holdout_data)
+    model.add_train_params(training_params)
+    model.train()
+
+    return model.score_dataset(holdout_data)
+
+
+def cross_validate(model_class, model_params, dataset_manager, num_folds=5,
+                   training_params=None, num_processes=None, threads_per_fold=1,
+                   shuffle=True, seed=None, wrangler_class=None):
+    """Run k-fold cross-validation, with the folds trained in parallel processes
+
+    Args:
+        model_class: architecture class to cross-validate
+        model_params: model params, each fold gets its own `name` and `path`
+            based on these
+        dataset_manager: dataset manager with all the samples, which need
+            to be arrays or lists
+        num_folds: number of folds
+        training_params: training params passed to `add_train_params`
+        num_processes: number of folds to train at once, defaults to the
+            number of available CPUs divided by `threads_per_fold`
+        threads_per_fold: intra-op threads for each fold's session
+        shuffle: randomly assign samples to folds
+        seed: random seed for assigning samples to folds
+        wrangler_class: ModelWrangler subclass to use instead of ModelWrangler
+
+    Returns:
+        dict with the holdout score and number of held-out samples for each
+        fold, and the mean and standard deviation of the scores across folds
+        (the mean is weighted by the number of samples in each fold)
+    """
+
+    wrangler_class = wrangler_class or ModelWrangler
+    training_params = training_params or {}
+    num_processes = num_processes or max(1, available_cpus() // threads_per_fold)
+
+    base_params = {
+        key: val for key, val in model_params.items()
+        if key != 'model_class'
+    }
+
+    folds = dataset_manager.split_folds(num_folds, shuffle=shuffle, seed=seed)
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(num_processes, num_folds), mp_context=ctx) as pool:
+        futures = []
+        for fold_idx, (training_data, holdout_data) in enumerate(folds):
+            fold_params = deepcopy(base_params)
+            fold_params['name'] = '{}_fold_{}'.format(base_params['name'], fold_idx)
+            fold_params['path'] = os.path.join(base_params['path'], 'fold_{}'.format(fold_idx))
+            fold_params['intra_op_threads'] = threads_per_fold
+            fold_params['inter_op_threads'] = 1
+
+            futures.append(pool.submit(
+                _run_fold,
+                wrangler_class, model_class, fold_params, training_params,
+                training_data, holdout_data
+            ))
+
+        fold_scores = []
+        for fold_idx, future in enumerate(futures):
+            fold_scores.append(future.result())
+            LOGGER.info('Fold %d: holdout score = %0.6f', fold_idx, fold_scores[-1])
+
+    fold_sizes = [len(holdout_data.X[0]) for _, holdout_data in folds]
+
+    return {
+        'fold_scores': fold_scores,
+        'fold_sizes': fold_sizes,
+        'mean_score': np.average(fold_scores, weights=fold_sizes),
+        'std_score': np.std(fold_scores),
+    }
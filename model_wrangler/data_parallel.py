@@ -0,0 +1,263 @@
+"""Module implements local multi-process data-parallel training
+
+The parent process starts a parameter server and `num_workers` worker
+processes, all on localhost. Each worker builds its own copy of the model
+with the variables placed on the parameter server, trains on its own shard
+of the training data and the gradients from every worker are averaged with a
+`SyncReplicasOptimizer` before each update.
+"""
+
+import sys
+import time
+import pickle
+import socket
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.reduction
+
+from copy import deepcopy
+
+import tensorflow as tf
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+# how long the other workers get to finish once the chief is done
+CHIEF_GRACE_SECS = 30
+
+
+def _free_ports(num_ports):
+    """Find a bunch of open ports on localhost"""
+
+    sockets = []
+    try:
+        for _ in range(num_ports):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('localhost', 0))
+            sockets.append(sock)
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def make_cluster_spec(num_workers):
+    """Make a cluster spec dict with one parameter server and
+    `num_workers` workers on localhost"""
+
+    addresses = ['localhost:{}'.format(port) for port in _free_ports(num_workers + 1)]
+    return {
+        'ps': addresses[:1],
+        'worker': addresses[1:],
+    }
+
+
+def _run_parameter_server(cluster_spec):
+    """Serve the model variables until the parent process kills us"""
+
+    server = tf.train.Server(
+        tf.train.ClusterSpec(cluster_spec),
+        job_name='ps',
+        task_index=0,
+        config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    )
+    server.join()
+
+
+def _run_worker(wrangler_class, model_class, model_params, training_params,
+                training_data, holdout_data):
+    """Train a copy of the model on a shard of the data"""
+
+    distributed = model_params['distributed']
+    server = tf.train.Server(
+        tf.train.ClusterSpec(distributed['cluster']),
+        job_name='worker',
+        task_index=distributed['task_index']
+    )
+    distributed['target'] = server.target
+
+    model = wrangler_class(model_class, model_params)
+    model.add_data(training_data, holdout_data)
+    model.add_train_params(training_params)
+    model.train()
+
+
+def _count_batches(dataset_manager, training_params):
+    """Count the batches in one (non-eternal) pass over a dataset manager"""
+
+    return sum(1 for _ in dataset_manager.get_next_batch(
+        batch_size=training_params.get('batch_size', 32),
+        stride=training_params.get('stride', 1),
+        eternal=False
+    ))
+
+
+def prepare_data_parallel(wrangler, num_workers, threads_per_worker=None):
+    """Pick the cluster's ports and make the arguments for each worker process,
+    without starting anything. Unless the training params set an
+    `epoch_length`, it gets set to the number of batches in the smallest
+    shard, since every worker has to take the same number of steps
+
+    Args:
+        wrangler: ModelWrangler with its data and training params added
+        num_workers: number of worker processes to train with
+        threads_per_worker: intra-op threads for each worker's session, if
+            the model params don't already set `intra_op_threads`
+
+    Returns:
+        cluster spec dict, and a list of the argument tuples for `_run_worker`
+
+    Raises:
+        OSError if the ports can't be bound, pickle.PicklingError if the
+        arguments can't be sent to a spawned process (e.g. the dataset
+        managers hold generators)
+    """
+
+    cluster_spec = make_cluster_spec(num_workers)
+
+    model_params = {
+        key: val for key, val in wrangler.model_params.items()
+        if key != 'model_class'
+    }
+    if threads_per_worker:
+        model_params.setdefault('intra_op_threads', threads_per_worker)
+        model_params.setdefault('inter_op_threads', 1)
+
+    training_params = dict(wrangler.training_params)
+    training_params['num_workers'] = 1
+
+    # workers that stopped at different times would deadlock the others
+    if training_params.pop('early_stopping', None):
+        LOGGER.warning('Early stopping is not supported in data-parallel training')
+
+    training_shards = [
+        wrangler.training_data.shard(num_workers, task_index)
+        for task_index in range(num_workers)
+    ]
+
+    # and so would shards with different numbers of batches, so every
+    # worker runs as many steps per epoch as the smallest shard has
+    if training_params.get('epoch_length', None) is None:
+        training_params['epoch_length'] = min(
+            _count_batches(shard, training_params) for shard in training_shards
+        )
+        if not training_params['epoch_length']:
+            LOGGER.warning('Some workers have no training batches, so nothing will be trained')
+
+    worker_args = []
+    for task_index in range(num_workers):
+        worker_params = deepcopy(model_params)
+        worker_params['distributed'] = {
+            'cluster': cluster_spec,
+            'task_index': task_index,
+        }
+
+        worker_training_params = dict(training_params)
+        if task_index > 0:
+            worker_training_params['verbose'] = False
+
+        args = (
+            type(wrangler), wrangler.model_params['model_class'],
+            worker_params, worker_training_params,
+            training_shards[task_index],
+            wrangler.holdout_data.shard(num_workers, task_index),
+        )
+
+        # find out now, rather than after the parameter server is up
+        try:
+            multiprocessing.reduction.ForkingPickler.dumps(args)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            raise pickle.PicklingError(
+                'Could not pickle the arguments for worker {}: {}'.format(task_index, err)
+            ) from err
+
+        worker_args.append(args)
+
+    return cluster_spec, worker_args
+
+
+def run_data_parallel(cluster_spec, worker_args):
+    """Start the parameter server and worker processes made by
+    `prepare_data_parallel`, and wait for the workers to finish
+
+    Args:
+        cluster_spec: cluster spec dict
+        worker_args: list of the argument tuples for `_run_worker`
+
+    Raises:
+        RuntimeError if any of the workers fail
+    """
+
+    LOGGER.info('Starting data-parallel training with cluster %s', cluster_spec)
+
+    # Spawn fresh interpreters instead of forking so that the workers
+    # don't inherit this process's TF runtime
+    ctx = multiprocessing.get_context('spawn')
+
+    ps_process = ctx.Process(target=_run_parameter_server, args=(cluster_spec,), daemon=True)
+    ps_process.start()
+
+    workers = []
+    stragglers = []
+    try:
+        for args in worker_args:
+            worker = ctx.Process(target=_run_worker, args=args)
+            worker.start()
+            workers.append(worker)
+
+        # if a worker dies, the others would wait on its gradients forever
+        running = list(workers)
+        while running:
+            multiprocessing.connection.wait([worker.sentinel for worker in running])
+            running = [worker for worker in running if worker.is_alive()]
+            if any(worker.exitcode for worker in workers if not worker.is_alive()):
+                break
+
+            # the chief has saved the model, and anyone still going
+            # much later is stuck waiting on gradients that won't come
+            if workers[0].exitcode == 0 and running:
+                deadline = time.time() + CHIEF_GRACE_SECS
+                for worker in running:
+                    worker.join(max(0, deadline - time.time()))
+                stragglers = [idx for idx, worker in enumerate(workers) if worker.is_alive()]
+                if stragglers:
+                    LOGGER.warning(
+                        'Stopping data-parallel workers %s, which were still running '
+                        'after the chief finished', stragglers
+                    )
+                break
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        ps_process.terminate()
+        ps_process.join()
+
+    failed = [
+        idx for idx, worker in enumerate(workers)
+        if worker.exitcode != 0 and idx not in stragglers
+    ]
+    if failed:
+        raise RuntimeError('Data-parallel workers {} failed'.format(failed))
+
+
+def train_data_parallel(wrangler, num_workers, threads_per_worker=None):
+    """Train a ModelWrangler's model with data-parallel worker processes,
+    see `prepare_data_parallel` and `run_data_parallel`
+
+    Returns:
+        path to the checkpoint the chief worker saved at the end of training
+    """
+
+    run_data_parallel(*prepare_data_parallel(
+        wrangler, num_workers, threads_per_worker=threads_per_worker
+    ))
+    return tf.train.latest_checkpoint(wrangler.model_params['path'])
@@ -8,6 +8,8 @@ import logging
 
 import random
 
+from copy import copy
+
 from itertools import islice, cycle, tee, chain
 from collections import Iterable, deque
 
@@ -24,6 +26,26 @@ LOGGER.addHandler(h)
 LOGGER.setLevel(logging.DEBUG)
 
 
+class IndexedView(object):
+    """Read-only view of some of the rows of an array or list, picked out
+    by index, so that subsets of a dataset don't need to be copied"""
+
+    def __init__(self, data, indexes):
+        self.data = data
+        self.indexes = np.asarray(indexes)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return IndexedView(self.data, self.indexes[idx])
+        return self.data[self.indexes[idx]]
+
+    def __iter__(self):
+        return (self.data[idx] for idx in self.indexes)
+
+
 class BaseDatasetManager(ABC):
     """
     Abstract class used to read in datasets and serve up data samples
@@ -70,6 +92,96 @@ class BaseDatasetManager(ABC):
             Y_batch = [y[idx:(idx + batch_size)] for y in Y]
             yield X_batch, Y_batch
 
+    @staticmethod
+    def _shard_data(x_in, num_shards, shard_idx):
+        """Take every `num_shards`th sample of an input, starting at
+        `shard_idx`. Arrays and lists are trimmed so that every shard
+        gets the same number of samples"""
+
+        if isinstance(x_in, (np.ndarray, list, tuple, IndexedView)):
+            shard_end = num_shards * (len(x_in) // num_shards)
+            return x_in[shard_idx:shard_end:num_shards]
+
+        return islice(x_in, shard_idx, None, num_shards)
+
+    def shard(self, num_shards, shard_idx):
+        """Return a copy of this dataset manager that only serves one shard of
+        the samples, e.g. for one worker in data-parallel training. Numpy
+        arrays are sliced into views rather than copied
+
+        Args:
+            num_shards: total number of shards
+            shard_idx: which shard to keep
+
+        Returns:
+            a new dataset manager
+        """
+
+        if not 0 <= shard_idx < num_shards:
+            raise ValueError('Shard {} does not exist out of {} shards'.format(
+                shard_idx, num_shards))
+
+        sharded = copy(self)
+        sharded.X = [self._shard_data(x, num_shards, shard_idx) for x in self.X]
+        if self.Y is not None:
+            sharded.Y = [self._shard_data(y, num_shards, shard_idx) for y in self.Y]
+
+        return sharded
+
+    def split_folds(self, num_folds, shuffle=True, seed=None):
+        """Split the samples into folds for cross-validation. The folds are
+        views that index into the original data instead of copies of it
+
+        Args:
+            num_folds: number of folds
+            shuffle: randomly assign samples to folds, instead of
+                using contiguous blocks of samples
+            seed: random seed for the shuffle
+
+        Returns:
+            list of (training, holdout) dataset managers, one per fold
+        """
+
+        data = self.X + (self.Y or [])
+        if not all(isinstance(x, (np.ndarray, list, tuple, IndexedView)) for x in data):
+            raise TypeError('Folds can only be made from arrays or lists of samples')
+
+        num_samples = len(data[0])
+        if num_folds < 2 or num_folds > num_samples:
+            raise ValueError('Cannot split {} samples into {} folds'.format(
+                num_samples, num_folds))
+
+        sample_order = np.arange(num_samples)
+        if shuffle:
+            np.random.RandomState(seed).shuffle(sample_order)
+        fold_indexes = np.array_split(sample_order, num_folds)
+
+        folds = []
+        for fold_idx, holdout_idx in enumerate(fold_indexes):
+            train_idx = np.concatenate(
+                [idx for other_idx, idx in enumerate(fold_indexes) if other_idx != fold_idx]
+            )
+            folds.append(
+                (self._subset(np.sort(train_idx)), self._subset(np.sort(holdout_idx)))
+            )
+
+        return folds
+
+    def _subset(self, indexes):
+        """Return a copy of this dataset manager that only serves some samples"""
+
+        def _view(x_in):
+            # 1D arrays get served as columns, same as in `_force_to_generators`
+            if isinstance(x_in, np.ndarray) and len(x_in.shape) == 1:
+                x_in = x_in.reshape(-1, 1)
+            return IndexedView(x_in, indexes)
+
+        subset = copy(self)
+        subset.X = [_view(x) for x in self.X]
+        if self.Y is not None:
+            subset.Y = [_view(y) for y in self.Y]
+        return subset
+
     def _get_cache(self, gen_list):
         """Turn a list of generators into a single generator
         that returns a list of samples"""
@@ -108,6 +220,27 @@ class BaseDatasetManager(ABC):
         LOGGER.info('Dataset has %d inputs', self.num_inputs)
         LOGGER.info('Dataset has %d outputs', self.num_outputs)
 
+    def get_all_batches(self, batch_size=256, **kwargs):
+        """
+        This generator yields every sample exactly once, in its original
+        order. It's meant for evaluation, so there's no shuffling, resampling
+        or caching
+
+        Args:
+            batch_size: int for number of samples in batch
+        Yields:
+            X, Y: lists of input/output samples
+        """
+
+        samples = zip(*[self._force_to_generators(x) for x in self.X + self.Y])
+        while True:
+            batch = list(islice(samples, batch_size))
+            if not batch:
+                return
+
+            columns = [list(col) for col in zip(*batch)]
+            yield columns[:self.num_inputs], columns[self.num_inputs:]
+
     @abstractmethod
     def get_next_batch(self, batch_size=32, eternal=False, **kwargs):
         """
@@ -377,6 +510,26 @@ class SequentialDatasetManager(BaseDatasetManager):
 
         yield X_batch, Y_batch
 
+    def get_all_batches(self, batch_size=256, stride=1, **kwargs):
+        """
+        This generator yields every window exactly once, in its original
+        order. It's meant for evaluation, so there's no shuffling
+
+        Args:
+            batch_size: int for number of samples in batch
+            stride: sample the data every N steps
+        Yields:
+            X, Y: lists of input/output samples
+        """
+
+        last_batch = None
+        for x, y in self._yield_batches(self.X, batch_size, stride=stride):
+            # a full final batch gets yielded twice by `_yield_batches`
+            if x is last_batch or not x[0]:
+                continue
+            last_batch = x
+            yield x, y
+
     def get_next_batch(self, batch_size=32, stride=1, eternal=False, **kwargs):
         """
         This generator should yield batches of training data
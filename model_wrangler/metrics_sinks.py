@@ -0,0 +1,136 @@
+"""Module implements lightweight sinks for logging training metrics
+
+A sink gets a small dict of metrics (e.g. the loss) every few training
+batches, taken from values that the training step already fetched, so
+logging at a fine grain doesn't need extra `sess.run`s or summary I/O.
+Add one to a ModelWrangler with `ModelWrangler.add_metrics_sink`.
+"""
+
+import os
+import csv
+import json
+import time
+
+from collections import deque
+
+import numpy as np
+
+
+class BaseMetricsSink(object):
+    """
+    Base class for metrics sinks. Subclasses need to implement `write_record`,
+    and can implement `flush` and `close` if they hold onto records
+    """
+
+    @staticmethod
+    def make_record(step, metrics):
+        """Make a flat dict of the step, wall time and metrics, with numpy
+        scalars turned into python numbers"""
+
+        record = {'step': int(step), 'time': time.time()}
+        for name, val in metrics.items():
+            record[name] = val.item() if isinstance(val, np.generic) else val
+        return record
+
+    def write(self, step, metrics):
+        """Log a dict of metric names -> values for a training step"""
+
+        self.write_record(self.make_record(step, metrics))
+
+    def write_record(self, record):
+        """Store a single record from `make_record`"""
+
+        raise NotImplementedError
+
+    def flush(self):
+        """Push any buffered records to wherever they're going"""
+
+        pass
+
+    def close(self):
+        """Flush and release any resources"""
+
+        self.flush()
+
+
+class RingBufferSink(BaseMetricsSink):
+    """Keeps the most recent records in memory"""
+
+    def __init__(self, max_records=10000):
+        """
+        Args:
+          max_records: number of records to keep, older ones get dropped
+        """
+
+        self.records = deque(maxlen=max_records)
+
+    def write_record(self, record):
+        self.records.append(record)
+
+    def values(self, name):
+        """Get the steps and values of a metric as a pair of arrays"""
+
+        records = [record for record in self.records if name in record]
+        return (
+            np.array([record['step'] for record in records]),
+            np.array([record[name] for record in records])
+        )
+
+
+class FileSink(BaseMetricsSink):
+    """
+    Writes records to a CSV or JSON-lines file, a batch at a time.
+    The CSV columns are taken from the first record written
+    """
+
+    FORMATS = ['csv', 'jsonl']
+
+    def __init__(self, filename, file_format=None, buffer_size=100):
+        """
+        Args:
+          filename: file to append records to
+          file_format: 'csv' or 'jsonl', defaults to the file extension
+          buffer_size: number of records to hold in memory between writes
+        """
+
+        if file_format is None:
+            file_format = os.path.splitext(filename)[1].lstrip('.').lower()
+
+        if file_format not in self.FORMATS:
+            raise ValueError(
+                'file_format must be one of {}, not {}'.format(self.FORMATS, file_format)
+            )
+
+        self.filename = filename
+        self.file_format = file_format
+        self.buffer_size = buffer_size
+
+        self.buffer = []
+        self.fieldnames = None
+
+    def write_record(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        write_header = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+        with open(self.filename, 'a', newline='') as file:
+            if self.file_format == 'jsonl':
+                file.writelines(json.dumps(record) + '\n' for record in self.buffer)
+            else:
+                if self.fieldnames is None:
+                    self.fieldnames = list(self.buffer[0])
+                writer = csv.DictWriter(file, fieldnames=self.fieldnames, extrasaction='ignore')
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(self.buffer)
+
+        self.buffer = []
@@ -4,8 +4,7 @@ import tensorflow as tf
 
 from model_wrangler.architecture import BaseArchitecture
 from model_wrangler.model.layers import (
-    append_dropout, append_batchnorm, append_dense,
-    append_conv, append_maxpooling,
+    append_dense, append_conv_pool_layer,
     append_deconv, append_unstride, append_unpool,
     fit_to_shape
     )
@@ -17,28 +16,6 @@ class ConvolutionalAutoencoderModel(BaseArchitecture):
 
     # pylint: disable=too-many-instance-attributes
 
-    def _encode_layer(self, in_layer, layer_param):
-
-        layer_stack = [in_layer]
-
-        layer_stack.append(
-            append_conv(self, layer_stack[-1], layer_param, 'conv')
-            )
-
-        layer_stack.append(
-            append_maxpooling(self, layer_stack[-1], layer_param, 'maxpool')
-            )
-
-        layer_stack.append(
-            append_batchnorm(self, layer_stack[-1], layer_param, 'batchnorm')
-            )
-
-        layer_stack.append(
-            append_dropout(self, layer_stack[-1], layer_param, 'dropout')
-            )
-
-        return layer_stack[-1]
-
 
     def _decode_layer(self, in_layer, layer_param):
 
@@ -89,7 +66,7 @@ class ConvolutionalAutoencoderModel(BaseArchitecture):
         for idx, layer_param in enumerate(encoding_params):
             with tf.variable_scope('encoding_{}'.format(idx)):
                 layer_stack.append(
-                    self._encode_layer(layer_stack[-1], layer_param)
+                    append_conv_pool_layer(self, layer_stack[-1], layer_param)
                 )
 
         with tf.variable_scope('embedding_layer'):
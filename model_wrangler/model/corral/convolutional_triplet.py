@@ -3,10 +3,7 @@
 import tensorflow as tf
 
 from model_wrangler.architecture import BaseArchitecture
-from model_wrangler.model.layers import (
-    append_dropout, append_batchnorm, append_dense, append_conv,
-    append_maxpooling
-)
+from model_wrangler.model.layers import append_conv_pool_layer
 
 from model_wrangler.model.losses import siamese_embedding_loss
 
@@ -18,34 +15,13 @@ class ConvolutionalTripletModel(BaseArchitecture):
 
     # pylint: disable=too-many-instance-attributes
 
-    def _conv_layer(self, in_layers, layer_param):
-        layer_stack = [in_layers]
-
-        layer_stack.append(
-            append_conv(self, layer_stack[-1], layer_param, 'conv')
-            )
-
-        layer_stack.append(
-            append_maxpooling(self, layer_stack[-1], layer_param, 'maxpool')
-            )
-
-        layer_stack.append(
-            append_batchnorm(self, layer_stack[-1], layer_param, 'batchnorm')
-            )
-
-        layer_stack.append(
-            append_dropout(self, layer_stack[-1], layer_param, 'dropout')
-            )
-
-        return layer_stack[-1]
-
     def build_embedder(self, in_layer, hidden_params):
         """Build a stack of layers for mapping an input to an embedding"""
 
         layer_stack = [in_layer]
         for idx, layer_param in enumerate(hidden_params):
             with tf.variable_scope('conv_layer_{}/'.format(idx)):
-                layer_stack.append(self._conv_layer(layer_stack[-1], layer_param))
+                layer_stack.append(append_conv_pool_layer(self, layer_stack[-1], layer_param))
 
         # Force unit-norm
         flat = tf.contrib.layers.flatten(layer_stack[-1])
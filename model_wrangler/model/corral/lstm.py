@@ -5,7 +5,9 @@ import numpy as np
 import tensorflow as tf
 
 from model_wrangler.architecture import BaseArchitecture
-from model_wrangler.model.layers import append_dense, append_lstm_stack
+from model_wrangler.model.layers import (
+    append_timedense, append_lstm_stack, append_bidir_lstm_stack
+)
 from model_wrangler.model.losses import loss_mse
 
 class LstmModel(BaseArchitecture):
@@ -18,14 +20,7 @@ class LstmModel(BaseArchitecture):
 
         learning_rate = params.get('learning_rate', 0.001)
         optimizer = tf.train.RMSPropOptimizer(learning_rate)
-
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies(update_ops):
-            capped_grads = [
-                (tf.clip_by_value(g, -1.0, 1.0), v)
-                for g, v in optimizer.compute_gradients(self.loss)
-            ]
-            train_step = optimizer.apply_gradients(capped_grads)
+        train_step = self.make_train_step(optimizer, params, clip_value=1.0)
 
         return train_step
 
@@ -39,6 +34,8 @@ class LstmModel(BaseArchitecture):
         in_sizes = params.get('in_sizes', [])
         recurr_params = params.get('recurr_params', [])
         out_sizes = params.get('out_sizes', [])
+        bidirectional = params.get('bidirectional', False)
+        fused_lstm = params.get('fused_lstm', None)
 
         #
         # Build model
@@ -57,9 +54,17 @@ class LstmModel(BaseArchitecture):
                 layer_stacks[idx_source] = [in_layer]
 
                 with tf.variable_scope('lstm_stack'):
-                    layer_stacks[idx_source].append(
-                        append_lstm_stack(self, layer_stacks[idx_source][-1], recurr_params, 'lstm')
-                    )
+                    if bidirectional:
+                        lstm_layer = append_bidir_lstm_stack(
+                            self, layer_stacks[idx_source][-1], recurr_params, 'lstm',
+                            fused=fused_lstm
+                        )
+                    else:
+                        lstm_layer = append_lstm_stack(
+                            self, layer_stacks[idx_source][-1], recurr_params, 'lstm',
+                            fused=bool(fused_lstm)
+                        )
+                    layer_stacks[idx_source].append(lstm_layer)
 
         embeds = tf.concat([
             tf.contrib.layers.flatten(layer_stack[-1])
@@ -67,10 +72,25 @@ class LstmModel(BaseArchitecture):
         ], axis=-1)
 
 
+        # Predict outputs from the last timestep of the LSTM stacks. The
+        # backward direction of a bidirectional stack ends on the first one
+        if bidirectional:
+            num_units = recurr_params[-1]['units']
+            final_outputs = tf.concat([
+                tf.concat([
+                    layer_stack[-1][:, -1:, :num_units],
+                    layer_stack[-1][:, :1, num_units:]
+                ], axis=-1)
+                for layer_stack in layer_stacks.values()
+            ], axis=-1)
+        else:
+            final_outputs = tf.concat([
+                layer_stack[-1][:, -1:, :]
+                for layer_stack in layer_stacks.values()
+            ], axis=-1)
+
         out_layer_preact = [
-            tf.expand_dims(
-                append_dense(self, embeds, {'num_units': out_size}, 'preact_{}'.format(idx)),
-            1)
+            append_timedense(self, final_outputs, {'num_units': out_size}, 'preact_{}'.format(idx))
             for idx, out_size in enumerate(out_sizes)
         ]
 
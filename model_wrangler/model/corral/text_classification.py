@@ -1,15 +1,11 @@
 """Module sets up Convolutional Text Classifier"""
 
-import numpy as np
 import tensorflow as tf
 
 from model_wrangler.model.text_tools import TextProcessor
 
 from model_wrangler.architecture import BaseTextArchitecture
-from model_wrangler.model.layers import (
-    append_dropout, append_batchnorm, append_dense, append_conv,
-    append_maxpooling
-)
+from model_wrangler.model.layers import append_dense, append_conv_pool_layer
 from model_wrangler.model.losses import loss_softmax_ce
 
 
@@ -21,27 +17,6 @@ class TextClassificationModel(BaseTextArchitecture):
 
     # pylint: disable=too-many-instance-attributes
 
-    def _conv_layer(self, in_layer, layer_param):
-        layer_stack = [tf.to_float(in_layer)]
-
-        layer_stack.append(
-            append_conv(self, layer_stack[-1], layer_param, 'conv')
-            )
-
-        layer_stack.append(
-            append_maxpooling(self, layer_stack[-1], layer_param, 'maxpool')
-            )
-
-        layer_stack.append(
-            append_batchnorm(self, layer_stack[-1], layer_param, 'batchnorm')
-            )
-
-        layer_stack.append(
-            append_dropout(self, layer_stack[-1], layer_param, 'dropout')
-            )
-
-        return layer_stack[-1]
-
     def setup_layers(self, params):
 
         #
@@ -53,8 +28,13 @@ class TextClassificationModel(BaseTextArchitecture):
         hidden_params = params.get('hidden_params', [])
         embed_params = params.get('embed_params', [])
         out_sizes = params.get('out_sizes', [])
+        in_graph_encoding = params.get('in_graph_encoding', False)
 
-        self.text_map = TextProcessor(pad_len=pad_len)
+        self.text_map = TextProcessor(
+            pad_len=pad_len,
+            cache_size=params.get('encode_cache_size', None),
+            cache_max_bytes=params.get('encode_cache_bytes', None)
+        )
         self.char_embeddings = self.make_embedding_layer()
 
         #
@@ -66,20 +46,11 @@ class TextClassificationModel(BaseTextArchitecture):
             for idx in range(num_in)
         ]
 
-        _func = lambda x_list: np.vstack([
-            np.array(self.text_map.string_to_ints(x))
-            for x in x_list
-        ])
-
         in_layers_int = [
-            tf.py_func(_func, [layer], tf.int64)
+            self.make_string_encode_layer(layer, in_graph=in_graph_encoding)
             for layer in in_layers
         ]
 
-        for l1, l2 in zip(in_layers, in_layers_int):
-            new_shape = l1.get_shape().as_list()
-            l2.set_shape([new_shape[0], pad_len])
-
         # Add layers on top of each input
         layer_stacks = {}
         for idx_source, in_layer in enumerate(in_layers_int):
@@ -88,7 +59,7 @@ class TextClassificationModel(BaseTextArchitecture):
                 for idx_layer, layer_param in enumerate(hidden_params):
                     with tf.variable_scope('params_{}'.format(idx_layer)):
                         layer_stacks[idx_source].append(
-                            self._conv_layer(layer_stacks[idx_source][-1], layer_param)
+                            append_conv_pool_layer(self, tf.to_float(layer_stacks[idx_source][-1]), layer_param)
                         )
 
         # Flatten/concat output inputs from each convolutional stack
@@ -7,7 +7,7 @@ import tensorflow as tf
 from model_wrangler.model.text_tools import TextProcessor
 
 from model_wrangler.architecture import BaseTextArchitecture
-from model_wrangler.model.layers import append_dense, append_lstm_stack
+from model_wrangler.model.layers import append_dense, append_timedense, append_lstm_stack
 from model_wrangler.model.losses import loss_softmax_ce
 
 class TextLstmModel(BaseTextArchitecture):
@@ -15,19 +15,29 @@ class TextLstmModel(BaseTextArchitecture):
 
     # pylint: disable=too-many-instance-attributes
 
+    def __init__(self, params):
+        self.fused_lstm = False
+        self.skip_padding = False
+        self.recurr_scope = None
+        self.decode_scope = None
+        self.gen_input = None
+        self.gen_temp = None
+        self.gen_length = None
+        self.gen_state_in = None
+        self.gen_state_out = None
+        self.gen_output = None
+        self.beam_input = None
+        self.beam_steps = None
+        self.beam_scores = None
+        self.beam_output = None
+        super().__init__(params)
+
     def setup_training_step(self, params):
         """Set up loss and training step"""
 
         learning_rate = params.get('learning_rate', 0.001)
         optimizer = tf.train.RMSPropOptimizer(learning_rate)
-
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies(update_ops):
-            capped_grads = [
-                (tf.clip_by_value(g, -1.0, 1.0), v)
-                for g, v in optimizer.compute_gradients(self.loss)
-            ]
-            train_step = optimizer.apply_gradients(capped_grads)
+        train_step = self.make_train_step(optimizer, params, clip_value=1.0)
 
         return train_step
 
@@ -40,21 +50,19 @@ class TextLstmModel(BaseTextArchitecture):
         in_size = params.get('win_length', 3)
         embed_size = params.get('embed_size', 64)
         recurr_params = params.get('recurr_params', [])
-
-        self.text_map = TextProcessor(pad_len=in_size)
+        in_graph_encoding = params.get('in_graph_encoding', False)
+        beam_width = params.get('beam_width', 4)
+        self.fused_lstm = params.get('fused_lstm', False)
+        self.skip_padding = params.get('skip_padding', False)
+
+        self.text_map = TextProcessor(
+            pad_len=in_size,
+            cache_size=params.get('encode_cache_size', None),
+            cache_max_bytes=params.get('encode_cache_bytes', None)
+        )
         self.char_embeddings = self.make_embedding_layer(embed_size=embed_size)
         vocab_size, embed_size = self.char_embeddings.get_shape().as_list()
 
-        _func_str_to_int = lambda x_list: np.vstack([
-            np.array(self.text_map.string_to_ints(x, use_pad=True))
-            for x in x_list
-        ])
-
-        _func_int_to_str = lambda x_list: [
-            self.text_map.ints_to_string(x)
-            for x in x_list
-        ]
-
         #
         # Build model
         #
@@ -66,8 +74,9 @@ class TextLstmModel(BaseTextArchitecture):
 
         with tf.variable_scope('input'):
 
-            in_layers_int = tf.py_func(_func_str_to_int, [in_layer], tf.int64, name='int')
-            in_layers_int.set_shape([None, in_size])
+            in_layers_int = self.make_string_encode_layer(
+                in_layer, in_graph=in_graph_encoding, name='int'
+            )
 
             in_layers_onehot = tf.reshape(
                 tf.one_hot(
@@ -101,24 +110,28 @@ class TextLstmModel(BaseTextArchitecture):
                 name='distro'
             )
 
-        with tf.variable_scope('recurr'):
-            lstm_outputs = append_lstm_stack(self, in_layers_embed, recurr_params, 'lstm')
-            lstm_size = lstm_outputs.get_shape().as_list()
+        if self.skip_padding:
+            in_lengths = self.make_sequence_length_layer(in_layers_int)
+        else:
+            in_lengths = None
 
-        with tf.variable_scope('decode'):
-            lstm_to_decode = tf.reshape(lstm_outputs, [-1, lstm_size[-1]])
+        with tf.variable_scope('recurr') as self.recurr_scope:
+            lstm_outputs = append_lstm_stack(
+                self, in_layers_embed, recurr_params, 'lstm', fused=self.fused_lstm,
+                sequence_length=in_lengths, left_padded=True
+            )
 
-            lstm_decoded = append_dense(
-                self, lstm_to_decode,
+        with tf.variable_scope('decode') as self.decode_scope:
+            lstm_decoded = append_timedense(
+                self, lstm_outputs,
                 {'num_units': embed_size, 'activation': 'tanh'},
                 'dense_0'
             )
 
-            embeds = tf.reshape(lstm_decoded, [-1, in_size, vocab_size], name='embed')
+            embeds = tf.identity(lstm_decoded, name='embed')
 
-            seq_innerprod = tf.reshape(
-                tf.matmul(lstm_decoded, self.char_embeddings, transpose_b=True),
-                [-1, in_size, vocab_size],
+            seq_innerprod = tf.tensordot(
+                lstm_decoded, self.char_embeddings, [[2], [1]],
                 name='innerprod'
             )
 
@@ -131,17 +144,264 @@ class TextLstmModel(BaseTextArchitecture):
         with tf.variable_scope('output'):
             #output_int = self.make_onehot_decode_layer(seq_distro[:, -1, ...], probabilistic=False)
             output_int = self.make_onehot_decode_layer(seq_distro[:, -1, ...], probabilistic=True, temp=1.0/50)
-            output_str = tf.py_func(_func_int_to_str, [output_int], tf.string, name='string')
-            output_str.set_shape([None])
+            output_str = self.make_string_decode_layer(
+                output_int, in_graph=in_graph_encoding, name='string'
+            )
 
         #
         # Set up loss
         #
 
+        if self.skip_padding:
+            # Only score predictions made from real (non-padding) characters
+            loss_weights = tf.greater_equal(
+                tf.range(in_size - 1),
+                tf.expand_dims(in_size - in_lengths, -1),
+                name='loss_weights'
+            )
+        else:
+            loss_weights = None
+
         loss = loss_softmax_ce(
             tf.reshape(seq_innerprod[:, :-1, :], [-1, vocab_size]),
             tf.reshape(in_layers_onehot[:, 1:, :], [-1, vocab_size]),
+            weights=loss_weights
+        )
+
+        self.setup_generation_layers(recurr_params, embed_size)
+        self.setup_beam_search_layers(
+            recurr_params, embed_size, beam_width, in_graph_encoding
         )
 
         tb_scalars = {}
         return [in_layer], [output_str], [target_layer], embeds, loss, tb_scalars
+
+    def _lstm_step(self, in_ints, state, recurr_params, embed_size, sequence_length=None):
+        """Run a [batch, time] layer of ints through the model's LSTM stack
+        starting from `state`, skipping leading padding if `sequence_length`
+        is given. This re-enters the scopes the weights were made in, so it
+        picks up the same weights no matter what scope it gets called from
+
+        Returns:
+            logits for the character following the last timestep, and the
+            new LSTM state
+        """
+
+        with tf.variable_scope(self.recurr_scope, reuse=True):
+            outputs, new_state = append_lstm_stack(
+                self, self.get_embeddings(in_ints), recurr_params, 'lstm',
+                initial_state=state, return_state=True, fused=self.fused_lstm,
+                sequence_length=sequence_length, left_padded=True
+            )
+
+        with tf.variable_scope(self.decode_scope, reuse=True):
+            decoded = append_dense(
+                self, outputs[:, -1, :],
+                {'num_units': embed_size, 'activation': 'tanh'},
+                'dense_0'
+            )
+            logits = tf.matmul(decoded, self.char_embeddings, transpose_b=True)
+
+        return logits, new_state
+
+    def setup_beam_search_layers(self, recurr_params, embed_size, beam_width, in_graph_encoding):
+        """Build an in-graph beam search that decodes `beam_width` beams for
+        a batch of prompts in a single `sess.run`
+
+        Args:
+            recurr_params: list of LSTM layer params used to build the model
+            embed_size: size of the character embeddings
+            beam_width: number of beams to keep for each prompt
+            in_graph_encoding: boolean for using TF string ops for the
+                string <-> int mapping
+        """
+
+        vocab_size = self.char_embeddings.get_shape().as_list()[0]
+
+        with tf.variable_scope('beam_search'):
+            self.beam_input = tf.placeholder("string", name="input", shape=[None,])
+            self.beam_steps = tf.placeholder_with_default(16, [], name='steps')
+
+            prime_ints = self.make_string_encode_layer(self.beam_input, in_graph=in_graph_encoding)
+            batch_size = tf.shape(prime_ints)[0]
+
+            zero_state = tuple(
+                tf.contrib.rnn.LSTMStateTuple(
+                    tf.zeros([batch_size, layer_param['units']]),
+                    tf.zeros([batch_size, layer_param['units']])
+                )
+                for layer_param in recurr_params
+            )
+
+        # First step picks the top `beam_width` characters after each prompt
+        if self.skip_padding:
+            prime_lengths = self.make_sequence_length_layer(prime_ints)
+        else:
+            prime_lengths = None
+
+        logits, state = self._lstm_step(
+            prime_ints, zero_state, recurr_params, embed_size, sequence_length=prime_lengths
+        )
+        scores, tokens = tf.nn.top_k(tf.nn.log_softmax(logits), k=beam_width)
+        state = tf.contrib.seq2seq.tile_batch(state, beam_width)
+        sequences = tf.reshape(tokens, [-1, 1])
+
+        def _beam_step(step, state, scores, sequences):
+            logits, state = self._lstm_step(
+                sequences[:, -1:], state, recurr_params, embed_size
+            )
+            log_probs = tf.reshape(
+                tf.nn.log_softmax(logits),
+                [batch_size, beam_width, vocab_size]
+            )
+
+            # Prune every (beam, next character) candidate down to the best few
+            candidate_scores = tf.reshape(
+                tf.expand_dims(scores, -1) + log_probs,
+                [batch_size, beam_width * vocab_size]
+            )
+            scores, candidate_idx = tf.nn.top_k(candidate_scores, k=beam_width)
+
+            parent_idx = tf.reshape(
+                candidate_idx // vocab_size +
+                tf.expand_dims(tf.range(batch_size) * beam_width, -1),
+                [-1]
+            )
+            tokens = tf.reshape(candidate_idx % vocab_size, [-1, 1])
+
+            state = tf.contrib.framework.nest.map_structure(
+                lambda layer: tf.gather(layer, parent_idx), state
+            )
+            sequences = tf.concat([tf.gather(sequences, parent_idx), tokens], axis=1)
+
+            return step + 1, state, scores, sequences
+
+        with tf.variable_scope('beam_search'):
+            _, _, scores, sequences = tf.while_loop(
+                lambda step, *_: step < self.beam_steps - 1,
+                _beam_step,
+                [tf.constant(0), state, scores, sequences],
+                shape_invariants=[
+                    tf.TensorShape([]),
+                    tf.contrib.framework.nest.map_structure(lambda x: x.get_shape(), state),
+                    scores.get_shape(),
+                    tf.TensorShape([None, None])
+                ]
+            )
+
+            self.beam_scores = tf.identity(scores, name='scores')
+            self.beam_output = tf.reshape(
+                self.make_string_decode_layer(sequences, in_graph=in_graph_encoding),
+                [-1, beam_width],
+                name='output'
+            )
+
+    def setup_generation_layers(self, recurr_params, embed_size):
+        """Build layers that run the LSTM stack forward from an explicit state
+        so that text can be generated one character at a time
+
+        Args:
+            recurr_params: list of LSTM layer params used to build the model
+            embed_size: size of the character embeddings
+        """
+
+        with tf.variable_scope('generate'):
+            self.gen_input = tf.placeholder(tf.int32, name='input', shape=[None, None])
+            self.gen_temp = tf.placeholder_with_default(1.0 / 50, [], name='temp')
+            self.gen_length = tf.placeholder_with_default(
+                tf.fill(tf.shape(self.gen_input)[:1], tf.shape(self.gen_input)[1]),
+                [None],
+                name='length'
+            )
+            self.gen_state_in = tuple(
+                tf.contrib.rnn.LSTMStateTuple(
+                    tf.placeholder(tf.float32, [None, layer_param['units']], name='c_{}'.format(idx)),
+                    tf.placeholder(tf.float32, [None, layer_param['units']], name='h_{}'.format(idx))
+                )
+                for idx, layer_param in enumerate(recurr_params)
+            )
+
+        gen_logits, self.gen_state_out = self._lstm_step(
+            self.gen_input, self.gen_state_in, recurr_params, embed_size,
+            sequence_length=self.gen_length if self.skip_padding else None
+        )
+        gen_distro = tf.nn.softmax(gen_logits, axis=-1)
+
+        with tf.variable_scope('generate'):
+            self.gen_output = tf.reshape(
+                self.make_onehot_decode_layer(gen_distro, probabilistic=True, temp=self.gen_temp),
+                [-1],
+                name='output'
+            )
+
+    def generate(self, sess, prompts, num_chars, temp=1.0/50):
+        """Generate text for a batch of prompts in parallel
+
+        Each prompt is run through the LSTM stack once, and after that the
+        LSTM state is carried across `sess.run` calls so each new character
+        only costs a single step of the stack.
+
+        Args:
+            sess: the session holding this model's weights
+            prompts: list of strings to start generating from
+            num_chars: number of characters to generate for each prompt
+            temp: sampling 'temperature'
+
+        Returns:
+            list of generated strings, one per prompt
+        """
+
+        in_ints = self.text_map.strings_to_array(prompts, use_pad=False)
+        if in_ints.shape[1] == 0:
+            in_ints = np.full((len(prompts), 1), self.text_map.pad_char_idx, dtype=np.int32)
+
+        state_in = [tensor for layer_state in self.gen_state_in for tensor in layer_state]
+        state_out = [tensor for layer_state in self.gen_state_out for tensor in layer_state]
+        state_vals = [
+            np.zeros((len(prompts), tensor.get_shape().as_list()[-1]), dtype=np.float32)
+            for tensor in state_in
+        ]
+
+        generated = np.zeros((len(prompts), num_chars), dtype=np.int64)
+        for idx in range(num_chars):
+            data_dict = {
+                self.gen_input: in_ints,
+                self.gen_temp: temp,
+                self.is_training: False
+            }
+            data_dict.update(zip(state_in, state_vals))
+
+            if self.skip_padding and idx == 0:
+                is_pad = in_ints == self.text_map.pad_char_idx
+                data_dict[self.gen_length] = in_ints.shape[1] - np.cumprod(is_pad, axis=1).sum(axis=1)
+
+            next_ints, state_vals = sess.run([self.gen_output, state_out], feed_dict=data_dict)
+
+            generated[:, idx] = next_ints
+            in_ints = next_ints[:, np.newaxis]
+
+        return self.text_map.ints_to_strings(generated)
+
+    def beam_search(self, sess, prompts, num_chars):
+        """Find the most likely continuations of a batch of prompts
+        with a beam search that runs entirely inside the graph
+
+        Args:
+            sess: the session holding this model's weights
+            prompts: list of strings to start decoding from
+            num_chars: number of characters to decode for each prompt
+
+        Returns:
+            list (one per prompt) of the decoded beams, best first, and
+            an array of their summed log-probabilities
+        """
+
+        data_dict = {
+            self.beam_input: prompts,
+            self.beam_steps: num_chars,
+            self.is_training: False
+        }
+        beams, scores = sess.run([self.beam_output, self.beam_scores], feed_dict=data_dict)
+
+        beams = [[beam.decode('ascii') for beam in row] for row in beams]
+        return beams, scores
@@ -1,3 +1,7 @@
+import os
+
+from functools import lru_cache
+
 import tensorflow as tf
 
 
@@ -8,6 +12,12 @@ CONV_FUNCS = {
 }
 
 
+SEPARABLE_CONV_FUNCS = {
+    1: tf.layers.separable_conv1d,
+    2: tf.layers.separable_conv2d,
+}
+
+
 DECONV_FUNCS = {
     1: tf.layers.conv1d,
     2: tf.layers.conv2d_transpose,
@@ -133,13 +143,14 @@ def append_dense(architecture, input_layer, layer_config, name):
 
 
 def append_timedense(architecture, input_layer, layer_config, name):
-    """Add time distributed dense connections to a layer
+    """Add time distributed dense connections to a [batch, time, features]
+    layer, using the same weights at every timestep
 
     Args:
         architecture: model architecture object
         input_layer: the previous layer that feeds into this
         layer_config: dict of layer params
-            'num_units' -> int or list of <dim> ints, default = 5
+            'num_units' -> int, default = 5
             'activation' -> activation function, default = 'None'
             'bias' -> bool for bias on/off, default = 'True'
             'activity_reg' -> dict of regularization:strength pair, default = {}
@@ -149,7 +160,29 @@ def append_timedense(architecture, input_layer, layer_config, name):
         TF layer with dense added
     """
 
-    return None
+    activation_func, reg_func = get_param_functions(layer_config)
+    num_units = layer_config.get('num_units', 5)
+
+    # Fold time into the batch dimension so the shared kernel gets
+    # applied to every timestep with a single matmul
+    in_shape = input_layer.get_shape().as_list()
+    flat_layer = tf.reshape(input_layer, [-1, in_shape[-1]])
+
+    dense_layer = tf.layers.dense(
+        flat_layer,
+        num_units,
+        activation=activation_func,
+        use_bias=layer_config.get('bias', True),
+        activity_regularizer=reg_func,
+        name=name
+    )
+
+    timedense_layer = tf.reshape(
+        dense_layer,
+        tf.concat([tf.shape(input_layer)[:-1], [num_units]], axis=0)
+    )
+    timedense_layer.set_shape(in_shape[:-1] + [num_units])
+    return timedense_layer
 
 
 def append_conv(architecture, input_layer, layer_config, name):
@@ -163,6 +196,10 @@ def append_conv(architecture, input_layer, layer_config, name):
             'num_units' -> int or list of <dim> ints, default = 5
             'kernel' -> int or list of <dim> ints, default = 3
             'strides' -> int or list of <dim> ints, default = 1
+            'separable' -> bool for depthwise-separable convolutions
+                (1D and 2D only), default = False
+            'depth_multiplier' -> int, number of depthwise channels per input
+                channel for separable convolutions, default = 1
         name: layer name
 
     Returns:
@@ -172,7 +209,18 @@ def append_conv(architecture, input_layer, layer_config, name):
     dim = get_layer_dim(input_layer) - 1
     activation_func, reg_func = get_param_functions(layer_config)
 
-    conv_func = CONV_FUNCS[dim]
+    conv_kwargs = {}
+    if layer_config.get('separable', False):
+        if dim not in SEPARABLE_CONV_FUNCS:
+            raise ValueError(
+                'Separable convolutions are only available for 1D and 2D inputs, '
+                'but this input is {}D'.format(dim)
+            )
+        conv_func = SEPARABLE_CONV_FUNCS[dim]
+        conv_kwargs['depth_multiplier'] = layer_config.get('depth_multiplier', 1)
+    else:
+        conv_func = CONV_FUNCS[dim]
+
     conv_layer = conv_func(
         input_layer,
         layer_config.get('num_units', 5),
@@ -181,11 +229,148 @@ def append_conv(architecture, input_layer, layer_config, name):
         activation=activation_func,
         activity_regularizer=reg_func,
         padding='same',
-        name=name
+        name=name,
+        **conv_kwargs
     )
     return conv_layer
 
 
+def _as_list(value, dim):
+    """Expand an int layer param into a list of <dim> ints"""
+
+    if isinstance(value, int):
+        return [value] * dim
+    return list(value)
+
+
+def append_conv_bn_block(architecture, input_layer, layer_config, name):
+    """Add a convolution -> batch normalization -> activation block
+
+    While training, this uses the fused batch normalization kernel. Otherwise
+    the batch norm scale/shift get folded into the convolution's kernel and
+    bias so that inference runs a single convolution per block (and freezing
+    the graph turns the folded weights into constants).
+
+    Args:
+        architecture: model architecture object
+        input_layer: the previous layer that feeds into this
+        layer_config: dict of layer params
+            'activation' -> activation function, default = 'None'
+            'num_units' -> int, default = 5
+            'kernel' -> int or list of <dim> ints, default = 3
+            'strides' -> int or list of <dim> ints, default = 1
+            'activity_reg' -> dict of regularization:strength pair, default = {}
+            'bn_momentum' -> momentum for the batch norm moving averages, default = 0.99
+        name: layer name
+
+    Returns:
+        TF layer with the convolution block added
+    """
+
+    dim = get_layer_dim(input_layer) - 1
+    activation_func, reg_func = get_param_functions(layer_config)
+
+    if layer_config.get('separable', False):
+        raise ValueError('Fused conv/batchnorm blocks do not support separable convolutions')
+
+    num_units = layer_config.get('num_units', 5)
+    kernel_size = _as_list(layer_config.get('kernel', 3), dim)
+    strides = _as_list(layer_config.get('strides', 1), dim)
+    momentum = layer_config.get('bn_momentum', 0.99)
+    epsilon = 1.0e-3
+
+    in_channels = input_layer.get_shape().as_list()[-1]
+
+    with tf.variable_scope(name):
+
+        kernel = tf.get_variable(
+            'kernel', kernel_size + [in_channels, num_units],
+            initializer=tf.glorot_uniform_initializer()
+        )
+        gamma = tf.get_variable('gamma', [num_units], initializer=tf.ones_initializer())
+        beta = tf.get_variable('beta', [num_units], initializer=tf.zeros_initializer())
+        moving_mean = tf.get_variable(
+            'moving_mean', [num_units], initializer=tf.zeros_initializer(), trainable=False
+        )
+        moving_variance = tf.get_variable(
+            'moving_variance', [num_units], initializer=tf.ones_initializer(), trainable=False
+        )
+
+        def _training_block():
+            conv_layer = tf.nn.convolution(input_layer, kernel, 'SAME', strides=strides)
+
+            # Fused batch norm only takes 4D inputs, but the stats are per-channel
+            # so all the spatial dimensions can be flattened into one
+            conv_shape = tf.shape(conv_layer)
+            bn_layer, batch_mean, batch_variance = tf.nn.fused_batch_norm(
+                tf.reshape(conv_layer, [conv_shape[0], 1, -1, num_units]),
+                gamma, beta,
+                epsilon=epsilon,
+                is_training=True
+            )
+            bn_layer = tf.reshape(bn_layer, conv_shape)
+            bn_layer.set_shape(conv_layer.get_shape())
+            return bn_layer, batch_mean, batch_variance
+
+        def _folded_block():
+            scale = gamma * tf.rsqrt(moving_variance + epsilon)
+            conv_layer = tf.nn.convolution(input_layer, kernel * scale, 'SAME', strides=strides)
+            bn_layer = tf.nn.bias_add(conv_layer, beta - moving_mean * scale)
+            return bn_layer, moving_mean, moving_variance
+
+        bn_layer, mean, variance = tf.cond(
+            architecture.is_training, _training_block, _folded_block
+        )
+
+        # These are no-ops outside of training since the cond returns the
+        # moving averages themselves
+        tf.add_to_collection(
+            tf.GraphKeys.UPDATE_OPS,
+            tf.assign_sub(moving_mean, (1.0 - momentum) * (moving_mean - mean))
+        )
+        tf.add_to_collection(
+            tf.GraphKeys.UPDATE_OPS,
+            tf.assign_sub(moving_variance, (1.0 - momentum) * (moving_variance - variance))
+        )
+
+        if activation_func is None:
+            block_layer = bn_layer
+        else:
+            block_layer = activation_func(bn_layer)
+
+        if reg_func:
+            tf.add_to_collection(tf.GraphKeys.REGULARIZATION_LOSSES, reg_func(block_layer))
+
+    return block_layer
+
+
+def append_conv_pool_layer(architecture, input_layer, layer_config):
+    """Add a layer of a convolutional stack: either a fused conv/batchnorm
+    block (if 'fused_block' is set) or conv -> batchnorm, then max pooling
+    and dropout. The parts get named 'conv_block'/'conv', 'maxpool',
+    'batchnorm' and 'dropout' in the current variable scope
+
+    Args:
+        architecture: model architecture object
+        input_layer: the previous layer that feeds into this
+        layer_config: dict of layer params, see `append_conv`,
+            `append_conv_bn_block`, `append_maxpooling` and `append_dropout`
+
+    Returns:
+        TF layer with the convolution, pooling and dropout added
+    """
+
+    if layer_config.get('fused_block', False):
+        layer = append_conv_bn_block(architecture, input_layer, layer_config, 'conv_block')
+        layer = append_maxpooling(architecture, layer, layer_config, 'maxpool')
+    else:
+        layer = append_conv(architecture, input_layer, layer_config, 'conv')
+        layer = append_maxpooling(architecture, layer, layer_config, 'maxpool')
+        layer = append_batchnorm(architecture, layer, layer_config, 'batchnorm')
+
+    return append_dropout(architecture, layer, layer_config, 'dropout')
+
+
 def append_deconv(architecture, input_layer, layer_config, name):
     """Add deconvolutions to a layer
 
@@ -412,54 +597,267 @@ def fit_to_shape(architecture, in_layer, layer_config, name):
     return in_layer_padded_trimmed
 
 
-def append_bidir_lstm_stack(architecture, input_layer, layer_configs, name):
-    """Adds stacked RNN layers"""
+def _right_align(input_layer, sequence_length):
+    """Move the padding of left-padded [batch, time, ...] sequences to the end"""
+
+    return tf.reverse_sequence(
+        tf.reverse(input_layer, axis=[1]),
+        sequence_length,
+        seq_axis=1,
+        batch_axis=0
+    )
+
+
+def _left_align(input_layer, sequence_length):
+    """Move the padding of right-padded [batch, time, ...] sequences to the start"""
+
+    return tf.reverse(
+        tf.reverse_sequence(input_layer, sequence_length, seq_axis=1, batch_axis=0),
+        axis=[1]
+    )
+
+
+def _keep_prob(architecture, dropout_rate):
+    """Keep probability for RNN dropout that only drops units while training"""
+
+    if not dropout_rate:
+        return 1.0
+
+    keep_prob = tf.cond(
+        architecture.is_training,
+        lambda: tf.constant(1.0 - dropout_rate),
+        lambda: tf.constant(1.0)
+    )
+    return keep_prob
+
+
+@lru_cache(maxsize=None)
+def gpu_available():
+    """Check whether tensorflow could use a GPU, without creating any devices
+    (listing the devices would set up every GPU and grab its memory). This
+    is True for CUDA builds of tensorflow unless `CUDA_VISIBLE_DEVICES`
+    hides every GPU"""
+
+    if not tf.test.is_built_with_cuda():
+        return False
+
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    return visible_devices is None or visible_devices.strip() not in ('', '-1')
+
+
+def _reverse_time(time_major_layer, sequence_length=None):
+    """Reverse the (non-padding) timesteps of a time-major layer"""
+
+    if sequence_length is None:
+        return tf.reverse(time_major_layer, axis=[0])
+
+    return tf.reverse_sequence(
+        time_major_layer, sequence_length, seq_axis=0, batch_axis=1
+    )
+
+
+def _append_fused_bidir_lstm_stack(architecture, input_layer, layer_configs,
+                                   sequence_length=None):
+    """Adds stacked bidirectional layers where each direction of each layer
+    is an `LSTMBlockFusedCell` running over the whole (time-major) sequence"""
+
+    layer_input = tf.transpose(input_layer, [1, 0, 2])
+
+    for idx, layer_param in enumerate(layer_configs):
+
+        dropout_rate = layer_param.get('dropout', 0.0)
+        if dropout_rate:
+            layer_input = tf.layers.dropout(
+                layer_input,
+                rate=dropout_rate,
+                training=architecture.is_training
+            )
+
+        with tf.variable_scope('cell_{}'.format(idx)):
+            output_fw, _ = tf.contrib.rnn.LSTMBlockFusedCell(layer_param['units'])(
+                layer_input,
+                dtype=tf.float32,
+                sequence_length=sequence_length,
+                scope='fw'
+            )
+
+            output_bw, _ = tf.contrib.rnn.LSTMBlockFusedCell(layer_param['units'])(
+                _reverse_time(layer_input, sequence_length),
+                dtype=tf.float32,
+                sequence_length=sequence_length,
+                scope='bw'
+            )
+            output_bw = _reverse_time(output_bw, sequence_length)
+
+        layer_input = tf.concat([output_fw, output_bw], axis=-1)
+
+    return tf.transpose(layer_input, [1, 0, 2])
+
+
+def append_bidir_lstm_stack(architecture, input_layer, layer_configs, name,
+                            sequence_length=None, left_padded=False, fused=None):
+    """Adds stacked bidirectional RNN layers
 
-    cells_fw = [
-        tf.contrib.rnn.DropoutWrapper(
-            tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
-            input_keep_prob=1 - layer_param.get('dropout', 0.0)
+    Args:
+        architecture: model architecture object
+        input_layer: the [batch, time, features] layer that feeds into this
+        layer_configs: list of dicts of layer params, one per LSTM layer
+            'units' -> int, number of LSTM units in each direction
+            'dropout' -> float, input dropout rate while training, default = 0.0
+        name: layer name
+        sequence_length: optional [batch] layer with the number of
+            non-padding timesteps in each sample
+        left_padded: boolean indicating whether the padding is at the start of
+            each sequence (like `TextProcessor` does) instead of the end
+        fused: boolean indicating whether to use `LSTMBlockFusedCell`s for
+            each direction (fast on CPU) instead of cuDNN-compatible cells.
+            The default (None) uses the fused cells unless there might be a
+            GPU (see `gpu_available`)
+
+    Returns:
+        TF layer with the concatenated forward/backward outputs at every timestep
+    """
+
+    if fused is None:
+        fused = not gpu_available()
+
+    if sequence_length is not None:
+        sequence_length = tf.to_int32(sequence_length)
+        if left_padded:
+            input_layer = _right_align(input_layer, sequence_length)
+
+    if fused:
+        output_sequence = _append_fused_bidir_lstm_stack(
+            architecture, input_layer, layer_configs, sequence_length=sequence_length
         )
-        for idx, layer_param in enumerate(layer_configs)
-    ]
 
-    cells_bw = [
-        tf.contrib.rnn.DropoutWrapper(
-            tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
-            input_keep_prob=1 - layer_param.get('dropout', 0.0)
+    else:
+        cells_fw = [
+            tf.contrib.rnn.DropoutWrapper(
+                tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
+                input_keep_prob=_keep_prob(architecture, layer_param.get('dropout', 0.0))
+            )
+            for idx, layer_param in enumerate(layer_configs)
+        ]
+
+        cells_bw = [
+            tf.contrib.rnn.DropoutWrapper(
+                tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
+                input_keep_prob=_keep_prob(architecture, layer_param.get('dropout', 0.0))
+            )
+            for idx, layer_param in enumerate(layer_configs)
+        ]
+
+        output_sequence, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(
+            cells_fw=cells_fw,
+            cells_bw=cells_bw,
+            inputs=input_layer,
+            sequence_length=sequence_length,
+            dtype=tf.float32
         )
-        for idx, layer_param in enumerate(layer_configs)
-    ]
-
-    output_sequence, _, _ = tf.contrib.rnn.stack_bidirectional_dynamic_rnn(
-        cells_fw=tf.nn.rnn_cell.MultiRNNCell(cells_fw),
-        cells_bw=tf.nn.rnn_cell.MultiRNNCell(cells_bw),
-        inputs=input_layer,
-        dtype=tf.float32
-    )
+
+    if sequence_length is not None and left_padded:
+        output_sequence = _left_align(output_sequence, sequence_length)
 
     return output_sequence
 
 
-def append_lstm_stack(architecture, input_layer, layer_configs, name):
-    """Adds stacked RNN layers"""
+def _append_fused_lstm_stack(architecture, input_layer, layer_configs,
+                             initial_state=None, sequence_length=None):
+    """Adds stacked `LSTMBlockFusedCell`s, each of which runs over the whole
+    (time-major) sequence in a single op, with dropout between layers"""
+
+    layer_input = tf.transpose(input_layer, [1, 0, 2])
 
-    cells = [
-        tf.contrib.rnn.DropoutWrapper(
-            #tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
-            tf.contrib.rnn.LSTMBlockCell(layer_param['units']),
-            input_keep_prob=1 - layer_param.get('dropout', 0.0)
+    final_state = []
+    for idx, layer_param in enumerate(layer_configs):
+
+        dropout_rate = layer_param.get('dropout', 0.0)
+        if dropout_rate:
+            layer_input = tf.layers.dropout(
+                layer_input,
+                rate=dropout_rate,
+                training=architecture.is_training
+            )
+
+        layer_input, layer_state = tf.contrib.rnn.LSTMBlockFusedCell(layer_param['units'])(
+            layer_input,
+            initial_state=None if initial_state is None else initial_state[idx],
+            dtype=tf.float32,
+            sequence_length=sequence_length,
+            scope='cell_{}'.format(idx)
         )
-        for idx, layer_param in enumerate(layer_configs)
-    ]
-
-    outputs, _ = tf.nn.dynamic_rnn(
-        cell=tf.nn.rnn_cell.MultiRNNCell(cells),
-        inputs=input_layer,
-        dtype=tf.float32,
-        time_major=False
-    )
+        final_state.append(tf.contrib.rnn.LSTMStateTuple(*layer_state))
+
+    outputs = tf.transpose(layer_input, [1, 0, 2])
+    return outputs, tuple(final_state)
+
+
+def append_lstm_stack(architecture, input_layer, layer_configs, name,
+                      initial_state=None, return_state=False, fused=False,
+                      sequence_length=None, left_padded=False):
+    """Adds stacked RNN layers
+
+    Args:
+        architecture: model architecture object
+        input_layer: the [batch, time, features] layer that feeds into this
+        layer_configs: list of dicts of layer params, one per LSTM layer
+            'units' -> int, number of LSTM units
+            'dropout' -> float, input dropout rate while training, default = 0.0
+        name: layer name
+        initial_state: optional tuple of `LSTMStateTuple`s, one per layer
+        return_state: boolean indicating whether to also return the final state
+        fused: boolean indicating whether to use `LSTMBlockFusedCell`s, which
+            run each layer over the whole sequence at once instead of stepping
+            through a while-loop. These are much faster on CPU, but their
+            weights aren't compatible with the un-fused stack
+        sequence_length: optional [batch] layer with the number of non-padding
+            timesteps in each sample. Padded timesteps are skipped, their
+            outputs are zeros and the final state is from the last real timestep
+        left_padded: boolean indicating whether the padding is at the start of
+            each sequence (like `TextProcessor` does) instead of the end
+
+    Returns:
+        TF layer with the LSTM outputs at every timestep, and the final
+        tuple of `LSTMStateTuple`s if `return_state`
+    """
+
+    if sequence_length is not None:
+        sequence_length = tf.to_int32(sequence_length)
+        if left_padded:
+            input_layer = _right_align(input_layer, sequence_length)
+
+    if fused:
+        outputs, final_state = _append_fused_lstm_stack(
+            architecture, input_layer, layer_configs,
+            initial_state=initial_state, sequence_length=sequence_length
+        )
+
+    else:
+        cells = [
+            tf.contrib.rnn.DropoutWrapper(
+                #tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(layer_param['units']),
+                tf.contrib.rnn.LSTMBlockCell(layer_param['units']),
+                input_keep_prob=_keep_prob(architecture, layer_param.get('dropout', 0.0))
+            )
+            for idx, layer_param in enumerate(layer_configs)
+        ]
+
+        outputs, final_state = tf.nn.dynamic_rnn(
+            cell=tf.nn.rnn_cell.MultiRNNCell(cells),
+            inputs=input_layer,
+            initial_state=initial_state,
+            sequence_length=sequence_length,
+            dtype=tf.float32,
+            time_major=False
+        )
+
+    if sequence_length is not None and left_padded:
+        outputs = _left_align(outputs, sequence_length)
 
     #output = outputs[:, -1, ...]
 
+    if return_state:
+        return outputs, final_state
+
     return outputs
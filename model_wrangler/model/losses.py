@@ -19,31 +19,47 @@ def loss_mse(observed, actual):
     return tf.reduce_sum(tf.squared_difference(observed, actual)) / tf.cast(numel, tf.float32)
 
 
-def loss_sigmoid_ce(observed, actual):
+def _weighted_mean(per_sample_loss, observed, weights=None):
+    """Average a loss over every element of `observed`, where each sample
+    can have an optional weight (e.g., 0 to mask out padding)"""
+
+    if weights is None:
+        numel = tf.cast(tf.reduce_prod(tf.size(observed)), tf.float32)
+        return tf.reduce_sum(per_sample_loss) / numel
+
+    weights = tf.cast(tf.reshape(weights, [-1]), tf.float32)
+    per_sample_loss = tf.reshape(per_sample_loss, [tf.size(weights), -1])
+    weighted_loss = tf.reduce_sum(per_sample_loss * tf.expand_dims(weights, -1))
+
+    num_per_sample = tf.cast(tf.size(observed) // tf.size(weights), tf.float32)
+    numel = tf.maximum(tf.reduce_sum(weights) * num_per_sample, 1.0)
+    return weighted_loss / numel
+
+
+def loss_sigmoid_ce(observed, actual, weights=None):
     """Calculate sigmoid cross entropy loss"""
 
     per_sample_loss = tf.nn.sigmoid_cross_entropy_with_logits(
         labels=actual,
         logits=observed
     )
-    numel = tf.reduce_prod(tf.size(observed))
-    per_batch_loss = tf.reduce_sum(per_sample_loss) / tf.cast(numel, tf.float32)
+    per_batch_loss = _weighted_mean(per_sample_loss, observed, weights=weights)
     return per_batch_loss
 
 
-def loss_softmax_ce(observed, actual):
-    """Calculate softmax cross entropy loss"""
+def loss_softmax_ce(observed, actual, weights=None):
+    """Calculate softmax cross entropy loss, `weights` is an optional
+    [batch] tensor of per-sample weights"""
 
     observed_shape = observed.get_shape().as_list()
     if len(observed_shape) == 2 and observed_shape[1] == 1:
-        return loss_sigmoid_ce(observed, actual)
+        return loss_sigmoid_ce(observed, actual, weights=weights)
 
     per_sample_loss = tf.nn.softmax_cross_entropy_with_logits_v2(
         logits=observed,
         labels=actual
     )
-    numel = tf.reduce_prod(tf.size(observed))
-    per_batch_loss = tf.reduce_sum(per_sample_loss) / tf.cast(numel, tf.float32)
+    per_batch_loss = _weighted_mean(per_sample_loss, observed, weights=weights)
     return per_batch_loss
 
 
@@ -59,6 +75,97 @@ def accuracy(observed, actual):
     acc = tf.reduce_mean(tf.cast(is_correct, tf.float32))
     return acc
 
+def _streaming(metric_func, name):
+    """Build a streaming metric in its own variable scope and return the
+    (value, update_op, reset_op) triple for it"""
+
+    with tf.variable_scope(None, default_name=name) as scope:
+        value, update_op = metric_func()
+
+    local_vars = tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=scope.name + '/')
+    reset_op = tf.variables_initializer(local_vars)
+    return value, update_op, reset_op
+
+
+def streaming_mean(values, weights=None, name='streaming_mean'):
+    """Streaming (weighted) mean of a tensor across batches
+
+    The streaming metrics accumulate totals in local variables: run
+    `reset_op` before the first batch, `update_op` on each batch, and
+    fetch `value` once at the end for the metric over every batch.
+
+    Returns:
+        (value, update_op, reset_op)
+    """
+
+    return _streaming(lambda: tf.metrics.mean(values, weights=weights), name)
+
+
+def streaming_accuracy(observed, actual):
+    """Streaming accuracy for one-hot encoded categories (or 0/1 values
+    for single outputs), see `streaming_mean`"""
+
+    observed_shape = observed.get_shape().as_list()
+    if len(observed_shape) == 2 and observed_shape[1] == 1:
+        labels, predictions = tf.cast(actual, tf.int32), tf.cast(observed, tf.int32)
+    else:
+        labels, predictions = tf.argmax(actual, axis=1), tf.argmax(observed, axis=1)
+
+    return _streaming(
+        lambda: tf.metrics.accuracy(labels, predictions), 'streaming_accuracy'
+    )
+
+
+def streaming_mse(observed, actual):
+    """Streaming mean squared error, see `streaming_mean`"""
+
+    return _streaming(
+        lambda: tf.metrics.mean_squared_error(actual, observed), 'streaming_mse'
+    )
+
+
+def streaming_ce(observed, actual):
+    """Streaming cross entropy for logits, sigmoid for single outputs and
+    softmax otherwise (same as `loss_softmax_ce`), see `streaming_mean`"""
+
+    observed_shape = observed.get_shape().as_list()
+    if len(observed_shape) == 2 and observed_shape[1] == 1:
+        per_sample_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+            labels=actual,
+            logits=observed
+        )
+    else:
+        per_sample_loss = tf.nn.softmax_cross_entropy_with_logits_v2(
+            logits=observed,
+            labels=actual
+        )
+
+    return streaming_mean(per_sample_loss, name='streaming_ce')
+
+
+def streaming_auc(observed, actual, from_logits=False, num_thresholds=200):
+    """Streaming ROC AUC for 0/1 targets, see `streaming_mean`
+
+    Args:
+        observed: predicted probabilities (or logits if `from_logits`)
+        actual: 0/1 targets
+        from_logits: apply a sigmoid to `observed` first
+        num_thresholds: number of thresholds used to approximate the ROC curve
+    """
+
+    predictions = tf.to_float(observed)
+    if from_logits:
+        predictions = tf.sigmoid(predictions)
+    predictions = tf.clip_by_value(predictions, 0.0, 1.0)
+
+    return _streaming(
+        lambda: tf.metrics.auc(
+            tf.cast(actual, tf.bool), predictions, num_thresholds=num_thresholds
+        ),
+        'streaming_auc'
+    )
+
+
 def loss_crossgroup_bias(observed, actual, group_idx):
     """Return the variance in errors across groups"""
 
@@ -1,9 +1,21 @@
 """Tools for string processing"""
 
+import sys
 import string
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
 from unidecode import unidecode
 
 
+# number of unicode code points, and the lookup tables made by
+# `TextProcessor.codepoint_table` for each set of `good_chars`
+NUM_CODEPOINTS = 0x110000
+CODEPOINT_TABLES = {}
+
+
 class TextProcessor(object):
     """Object that handles mapping characters to onehot embeddings
     and back and forth. Generally uses unicode
@@ -13,7 +25,15 @@ class TextProcessor(object):
     PAD_CHAR = ' '
     DEFAULT_CHARS = string.ascii_letters + string.digits
 
-    def __init__(self, pad_len=None, good_chars=None):
+    def __init__(self, pad_len=None, good_chars=None, cache_size=None, cache_max_bytes=None):
+        """
+        Args:
+          pad_len: number of characters to pad/trim strings to
+          good_chars: string of characters that get their own int
+          cache_size: max number of encoded strings to keep in an LRU cache,
+            the default (None) doesn't cache anything
+          cache_max_bytes: max memory used by the cache, None for no limit
+        """
 
         if good_chars is None:
             self.good_chars = self.DEFAULT_CHARS
@@ -36,32 +56,195 @@ class TextProcessor(object):
         self.int_to_char[self.missing_char_idx] = unidecode(self.MISSING_CHAR)
         self.int_to_char[self.pad_char_idx] = unidecode(self.PAD_CHAR)
 
+        # Translation table from ASCII byte values to ints so that whole
+        # strings can be mapped with a single numpy lookup
+        self.byte_to_int = np.full(256, self.missing_char_idx, dtype=np.int32)
+        for char, idx in self.char_to_int.items():
+            self.byte_to_int[ord(char)] = idx
+
+        # Lookup from ints back to ASCII byte values, unknown ints decode as padding
+        self.int_to_byte = np.full(self.num_chars + 2, ord(self.PAD_CHAR), dtype=np.uint8)
+        for idx, char in self.int_to_char.items():
+            self.int_to_byte[idx] = ord(char)
+
+        # LRU cache of encoded strings
+        self.cache_size = cache_size
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def _to_ascii_bytes(in_string):
+        """Turn a string (or utf-8 bytes) into ASCII bytes, only running
+        `unidecode` when there are non-ASCII characters in it"""
+
+        if isinstance(in_string, bytes):
+            if in_string.isascii():
+                return in_string
+            in_string = str(in_string, 'utf-8')
+
+        if not in_string.isascii():
+            in_string = unidecode(in_string)
+
+        return in_string.encode('ascii', errors='replace')
+
+    def _encode(self, in_string, max_len=None):
+        """Map a single string to an int32 array, keeping only the
+        last `max_len` characters"""
+
+        byte_string = self._to_ascii_bytes(in_string)
+        if max_len is not None:
+            byte_string = byte_string[-max_len:] if max_len else b''
+
+        return self.byte_to_int[np.frombuffer(byte_string, dtype=np.uint8)]
+
+    def _encode_cached(self, in_string, max_len=None):
+        """Same as `_encode`, but pulls recently-seen strings from the cache"""
+
+        if not self.cache_size and not self.cache_max_bytes:
+            return self._encode(in_string, max_len=max_len)
+
+        key = (in_string, max_len)
+        with self._cache_lock:
+            ints = self._cache.get(key)
+            if ints is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return ints
+            self.cache_misses += 1
+
+        ints = self._encode(in_string, max_len=max_len)
+        ints.flags.writeable = False
+
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = ints
+                self._cache_bytes += ints.nbytes + sys.getsizeof(in_string)
+
+            while self._cache and (
+                    (self.cache_size and len(self._cache) > self.cache_size) or
+                    (self.cache_max_bytes and self._cache_bytes > self.cache_max_bytes)
+            ):
+                (old_string, _), old_ints = self._cache.popitem(last=False)
+                self._cache_bytes -= old_ints.nbytes + sys.getsizeof(old_string)
+
+        return ints
+
+    def codepoint_table(self):
+        """Get the ints that `strings_to_array` maps each unicode code point
+        to, for encoding strings with a lookup table instead of `unidecode`.
+        A code point can map to any number of ints, e.g. 'ß' -> 'ss'
+
+        The table covers every code point. It's split into blocks of 256
+        code points, and every block that `unidecode` maps to nothing shares
+        a single empty row, so it stays small. Tables only depend on
+        `good_chars`, so they get shared between processors
+
+        Returns:
+            int32 array mapping each block (`codepoint >> 8`) to a row,
+            int32 array of offsets where the ints for each code point start
+            (code point `c` is at `256 * row + (c & 255)`, with one extra
+            offset at the end), and a uint8 array of all the ints
+        """
+
+        if self.good_chars not in CODEPOINT_TABLES:
+            # good_chars are all ASCII, so every int fits in a byte
+            block_rows = np.zeros(NUM_CODEPOINTS >> 8, dtype=np.int32)
+            lengths = [np.zeros(256, dtype=np.int32)]
+            encoded = []
+
+            for block in range(NUM_CODEPOINTS >> 8):
+                block_chars = [chr(codepoint) for codepoint in range(block << 8, (block + 1) << 8)]
+
+                # surrogates never come out of a UTF-8 decoder, and most blocks
+                # transliterate to nothing so one call is enough to skip them
+                if 0xD8 <= block < 0xE0 or not unidecode(''.join(block_chars)):
+                    continue
+
+                block_ints = [self._encode(char) for char in block_chars]
+                block_rows[block] = len(lengths)
+                lengths.append(np.array([len(ints) for ints in block_ints], dtype=np.int32))
+                encoded.extend(block_ints)
+
+            values = np.concatenate(encoded).astype(np.uint8)
+            splits = np.zeros(256 * len(lengths) + 1, dtype=np.int32)
+            splits[1:] = np.cumsum(np.concatenate(lengths))
+
+            CODEPOINT_TABLES[self.good_chars] = (block_rows, splits, values)
+
+        return CODEPOINT_TABLES[self.good_chars]
+
+    def cache_info(self):
+        """Return a dict of stats on the encoded-string cache"""
+
+        with self._cache_lock:
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self._cache),
+                'bytes': self._cache_bytes,
+            }
+
+    def clear_cache(self):
+        """Empty the encoded-string cache and reset its counters"""
+
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def strings_to_array(self, in_strings, use_pad=True):
+        """Take a list of strings, and turn it into an [N, pad_len] int32 array
+
+        Strings are left-padded with the pad index. If there is no `pad_len`
+        (or `use_pad` is False) the strings are padded out to the longest one
+        in the batch instead of being truncated.
+        """
+
+        max_len = self.pad_len if use_pad else None
+        encoded = [self._encode_cached(in_string, max_len=max_len) for in_string in in_strings]
+
+        if max_len is None:
+            max_len = max((len(ints) for ints in encoded), default=0)
+
+        out_array = np.full((len(encoded), max_len), self.pad_char_idx, dtype=np.int32)
+        for row, ints in zip(out_array, encoded):
+            if len(ints):
+                row[max_len - len(ints):] = ints
+
+        return out_array
+
     def string_to_ints(self, in_string, use_pad=True):
         """Take a sting, and turn it into a list of integers"""
 
-        try:
-            in_string = str(in_string, 'utf-8')
-        except TypeError:
-            pass
+        return self.strings_to_array([in_string], use_pad=use_pad)[0].tolist()
+
+    def ints_to_strings(self, in_ints, as_bytes=False):
+        """Take an [N, len] array of ints, turn each row into a string
 
-        char_list = list(unidecode(in_string))
+        Args:
+            in_ints: 2d array (or list of lists) of ints
+            as_bytes: return ASCII bytes instead of str
 
-        if use_pad and self.pad_len is not None:
-            char_list = char_list[-self.pad_len:]
+        Returns:
+            list of N strings
+        """
 
-        int_list = [self.char_to_int.get(c, self.missing_char_idx) for c in char_list]
+        in_ints = np.asarray(in_ints, dtype=np.int64)
+        in_range = (in_ints >= 0) & (in_ints < len(self.int_to_byte))
+        byte_array = self.int_to_byte[np.where(in_range, in_ints, self.pad_char_idx)]
 
-        char_len = len(char_list)
-        if use_pad and self.pad_len is not None and char_len < self.pad_len:
-            pad_size = self.pad_len - char_len
-            pad = [self.pad_char_idx] * pad_size
-            int_list = pad + int_list
+        out_strings = [row.tobytes() for row in byte_array]
+        if not as_bytes:
+            out_strings = [row.decode('ascii') for row in out_strings]
 
-        return int_list
+        return out_strings
 
     def ints_to_string(self, in_ints):
         """Take a list of ints, turn them into a single string"""
 
-        char_list = [self.int_to_char.get(c, self.pad_char_idx) for c in in_ints]
-        out_string = str(''.join(char_list))
-        return out_string
+        return self.ints_to_strings([in_ints])[0]
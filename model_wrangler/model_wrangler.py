@@ -2,15 +2,24 @@
 
 import sys
 import os
+import re
 import logging
 import json
+import math
+import time
+import queue
 import pickle
+import threading
+import contextlib
 
 from multiprocessing import cpu_count
 
 import numpy as np
 import tensorflow as tf
 
+from model_wrangler.data_parallel import prepare_data_parallel, run_data_parallel
+from model_wrangler.model.losses import streaming_mean
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
 
 LOGGER = logging.getLogger(__name__)
@@ -21,6 +30,12 @@ h.setFormatter(
 LOGGER.addHandler(h)
 LOGGER.setLevel(logging.DEBUG)
 
+XLA_JIT_MODES = [None, 'session', 'scoped']
+
+# set once a ModelWrangler makes a session, after which TF has (or soon
+# will have) read its XLA flags for this process, see `set_xla_jit`
+SESSION_STARTED = False
+
 
 def set_session_params(cfg_params=None):
     """Set session configuration. Use this to switch between CPU and GPU tasks"""
@@ -31,18 +46,192 @@ def set_session_params(cfg_params=None):
     return tf.ConfigProto(**cfg_params)
 
 
-def set_max_threads(sess_cfg, max_threads=None):
-    """Set max threads used in session"""
+def _cgroup_cpu_limit():
+    """Return the CPU limit set by a cgroup CPU quota (v2 or v1), or None if
+    there isn't one"""
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as file:
+            quota = int(file.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as file:
+            period = int(file.read())
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """Return the number of CPUs this process can actually use, taking
+    CPU affinity and cgroup CPU quotas into account"""
+
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cpus = cpu_count()
+
+    cgroup_limit = _cgroup_cpu_limit()
+    if cgroup_limit is not None:
+        num_cpus = min(num_cpus, int(math.ceil(cgroup_limit)))
+
+    return max(num_cpus, 1)
+
+
+def set_max_threads(sess_cfg, max_threads=None, inter_op_threads=None, shared_pool=None):
+    """Set max threads used in session
+
+    TF1 sizes a process-wide inter-op pool from the first session in the
+    process, so when thread counts are given the session gets its own
+    inter-op pool (`use_per_session_threads`) to make sure they apply. The
+    intra-op pool belongs to the CPU device and is also made by the first
+    session, so compare intra-op counts in separate processes.
+
+    Args:
+        sess_cfg: tf.ConfigProto for the session
+        max_threads: number of threads used within an op (e.g., a matmul),
+            defaults to the number of CPUs available to this process
+        inter_op_threads: number of ops that can run at once, each of which
+            can use `max_threads` threads. Defaults to `max_threads` if that's
+            given, otherwise to 2 (or 1 on a single CPU) so that the pools
+            don't oversubscribe the CPUs
+        shared_pool: name of an inter-op thread pool shared by every session in
+            this process that uses the same name, e.g. when several
+            ModelWranglers share a machine. The pool's size is set by
+            whichever session creates it first
+
+    Returns:
+        the updated tf.ConfigProto
+    """
+
+    per_session_threads = max_threads is not None or inter_op_threads is not None
+
+    if inter_op_threads is None:
+        inter_op_threads = max_threads or min(2, available_cpus())
 
     if max_threads is None:
-        max_threads = cpu_count()
+        max_threads = available_cpus()
 
     sess_cfg.intra_op_parallelism_threads = max_threads
-    sess_cfg.inter_op_parallelism_threads = max_threads
+    if shared_pool:
+        thread_pool = sess_cfg.session_inter_op_thread_pool.add()
+        thread_pool.num_threads = inter_op_threads
+        thread_pool.global_name = shared_pool
+    else:
+        sess_cfg.inter_op_parallelism_threads = inter_op_threads
+        sess_cfg.use_per_session_threads = per_session_threads
+
     sess_cfg.allow_soft_placement = True
     return sess_cfg
 
 
+def set_xla_jit(sess_cfg, xla_jit=None):
+    """Turn on XLA JIT compilation for a whole session
+
+    The JIT level is part of the session config, but on CPU TF also needs
+    the `--tf_xla_cpu_global_jit` flag in the `TF_XLA_FLAGS` environment
+    variable. TF only reads that once per process, the first time any
+    session optimizes a graph, so the flag only gets added if no
+    ModelWrangler has made a session yet. Otherwise it's too late and a
+    warning gets logged: the JIT level still applies, but not to CPU ops.
+    Sessions made outside of ModelWrangler can't be seen here, so it's
+    safest to set `TF_XLA_FLAGS` before starting python.
+
+    The flag doesn't turn on XLA for any other sessions, it only lets the
+    JIT level of sessions that set one (like this one) apply to CPU ops
+
+    Args:
+        sess_cfg: tf.ConfigProto for the session
+        xla_jit: 'session' to JIT compile everything XLA can handle in the
+            session. 'scoped' JIT compilation is set up by the architecture
+            when it builds its layers, so it (and None) leaves the config alone
+
+    Returns:
+        the updated tf.ConfigProto
+    """
+
+    if xla_jit not in XLA_JIT_MODES:
+        raise ValueError('`xla_jit` must be one of {}'.format(XLA_JIT_MODES))
+
+    if xla_jit == 'session':
+        sess_cfg.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+        # Global JIT only clusters CPU ops when this flag is set
+        xla_flags = os.environ.get('TF_XLA_FLAGS', '')
+        if '--tf_xla_cpu_global_jit' not in xla_flags:
+            if SESSION_STARTED:
+                LOGGER.warning(
+                    'TF has already read TF_XLA_FLAGS in this process, so session-wide '
+                    'XLA JIT won\'t compile CPU ops. Set TF_XLA_FLAGS=--tf_xla_cpu_global_jit '
+                    'before starting python to compile them'
+                )
+            else:
+                LOGGER.info('Adding --tf_xla_cpu_global_jit to TF_XLA_FLAGS for this process')
+                os.environ['TF_XLA_FLAGS'] = ' '.join([xla_flags, '--tf_xla_cpu_global_jit']).strip()
+
+    return sess_cfg
+
+
+
+def prefetch(iterator, num_prefetch=2):
+    """Pull items out of an iterator in a background thread, so the next
+    few items are ready while the current one is being used
+
+    Args:
+        iterator: iterator to pull from
+        num_prefetch: max number of items to have waiting
+
+    Yields:
+        the items from the iterator, in order
+    """
+
+    done = object()
+    items = queue.Queue(maxsize=max(num_prefetch, 1))
+    stop = threading.Event()
+
+    def _put(entry):
+        # give up if the consumer has stopped taking items
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer():
+        try:
+            for item in iterator:
+                if not _put((item, None)):
+                    return
+        except Exception as err:  # pylint: disable=broad-except
+            _put((done, err))
+        else:
+            _put((done, None))
+
+    thread = threading.Thread(target=_producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
 
 class ModelWrangler(object):
     """
@@ -65,7 +254,11 @@ class ModelWrangler(object):
     def new_session(self):
         """Make Tensorflow session"""
 
+        global SESSION_STARTED
+        SESSION_STARTED = True
+
         sess = tf.Session(
+            self.distributed.get('target', ''),
             graph=self.tf_mod.graph,
             config=self.session_params
         )
@@ -74,12 +267,42 @@ class ModelWrangler(object):
     def initialize(self):
         """Initialize model weights"""
 
-        initializer = tf.variables_initializer(
-            self.tf_mod.graph.get_collection(
-                tf.GraphKeys.GLOBAL_VARIABLES
-                )
+        with self.tf_mod.graph.as_default():
+            if self.is_chief:
+                initializer = tf.variables_initializer(
+                    self.tf_mod.graph.get_collection(
+                        tf.GraphKeys.GLOBAL_VARIABLES
+                        )
+                    )
+                self.sess.run(initializer)
+            else:
+                self._wait_for_chief()
+
+            if self.tf_mod.sync_optimizer is not None:
+                self._start_sync_replicas()
+
+    def _wait_for_chief(self, poll_interval=0.5):
+        """Wait until the chief data-parallel worker initializes the
+        variables on the parameter server"""
+
+        uninitialized = tf.report_uninitialized_variables(tf.global_variables())
+        while len(self.sess.run(uninitialized)):
+            time.sleep(poll_interval)
+
+    def _start_sync_replicas(self):
+        """Set up the gradient queues and tokens used to synchronize
+        data-parallel workers. The chief also runs the queue runner
+        that aggregates the gradients from every worker"""
+
+        sync_optimizer = self.tf_mod.sync_optimizer
+        if self.is_chief:
+            self.sess.run(sync_optimizer.chief_init_op)
+            sync_optimizer.get_chief_queue_runner().create_threads(
+                self.sess, daemon=True, start=True
             )
-        self.sess.run(initializer)
+            self.sess.run(sync_optimizer.get_init_tokens_op())
+        else:
+            self.sess.run(sync_optimizer.local_step_init_op)
 
     def make_data_dict(self, x_data, y_data, is_training=False):
         """Make a dict of data for feed_dict"""
@@ -106,18 +329,40 @@ class ModelWrangler(object):
         self.training_gen = None
         self.holdout_gen = None
         self.training_params = {}
+        self.num_accumulated = 0
+        self.num_train_batches = 0
+        self.metrics_sinks = []
+
+        self._eval_ops = {}
+        self._tensor_index = {}
+        self._tensor_index_version = None
+
+        self.best_saver = None
+        self.best_checkpoint = None
+        self.best_score = np.inf
+        self.epochs_since_best = 0
 
         self.model_params = model_params
         self.model_params['model_class'] = model_class
 
-        self.tf_mod = model_class(model_params)
-
-        self.session_params = set_max_threads(
-            set_session_params(
-                {'log_device_placement': False}
-            )
+        # set for the worker processes in data-parallel training
+        self.distributed = model_params.get('distributed', None) or {}
+        self.is_chief = self.distributed.get('task_index', 0) == 0
+
+        self.session_params = set_xla_jit(
+            set_max_threads(
+                set_session_params(
+                    {'log_device_placement': False}
+                ),
+                max_threads=model_params.get('intra_op_threads', None),
+                inter_op_threads=model_params.get('inter_op_threads', None),
+                shared_pool=model_params.get('shared_thread_pool', None)
+            ),
+            xla_jit=model_params.get('xla_jit', None)
         )
 
+        self.tf_mod = model_class(model_params)
+
         self.sess = self.new_session()
         
         self.initialize()
@@ -133,6 +378,29 @@ class ModelWrangler(object):
         self.training_params = training_params
         return self
 
+    def add_metrics_sink(self, sink, interval=10, scalars=None):
+        """Log metrics to a sink (see `model_wrangler.metrics_sinks`) while
+        training. The metrics are fetched in the same `sess.run` as the
+        training step, so they come almost for free. Sinks only get fed in
+        this process, not by data-parallel worker processes
+
+        Args:
+            sink: metrics sink, e.g. a `RingBufferSink` or `FileSink`
+            interval: log every `interval` training batches
+            scalars: names from the model's `tb_scalars` to log along with
+                the loss
+
+        Returns:
+            self
+        """
+
+        fetches = {'loss': self.tf_mod.loss}
+        for name in scalars or []:
+            fetches[name] = self.tf_mod.tb_scalars[name]
+
+        self.metrics_sinks.append((sink, interval, fetches))
+        return self
+
     def _restore_train_params(self):
         # Restore training parameters (if they exist) training params
 
@@ -147,6 +415,10 @@ class ModelWrangler(object):
     def save(self, iteration):
         """Save model parameters in a JSON and model weights in TF format"""
 
+        # only one data-parallel worker needs to write the shared weights
+        if not self.is_chief:
+            return
+
         LOGGER.info('Saving weights file in %s', self.model_params['path'])
 
         try:
@@ -166,7 +438,10 @@ class ModelWrangler(object):
 
         # Save model parameters, training parameters
         with open(os.path.join(self.model_params['path'], 'model_params.pickle'), 'wb') as file:
-            pickle.dump(self.model_params, file)
+            pickle.dump(
+                {key: val for key, val in self.model_params.items() if key != 'distributed'},
+                file
+            )
 
         if self.training_params:
             with open(os.path.join(self.model_params['path'], 'train_params.pickle'), 'wb') as file:
@@ -219,21 +494,126 @@ class ModelWrangler(object):
     def score(self, input_x, target_y, score_func=None):
         """Measure model's current performance
         for a set of input_x and target_y using some scoring function
-        `score_func` (defults to model loss function)
+        `score_func` (defults to model loss function). `score_func` can be
+        a per-batch metric like `losses.accuracy` or a streaming one like
+        `losses.streaming_auc`, and its ops only get built the first time
         """
 
         data_dict = self.make_data_dict(input_x, target_y, is_training=False)
 
         if score_func is None:
-            score_func = self.tf_mod.loss
-        else:
-            with self.tf_mod.graph.as_default():
-                score_func = tf.reduce_mean([
-                    score_func(*pair)
-                    for pair in zip(self.tf_mod.outputs, self.tf_mod.targets)
-                ])
-        val = score_func.eval(feed_dict=data_dict, session=self.sess)
-        return val
+            return self.tf_mod.loss.eval(feed_dict=data_dict, session=self.sess)
+
+        name = self._metric_names([score_func])[0]
+        value, update_op, reset_op = self._get_eval_ops([score_func])[name]
+        self.sess.run(reset_op)
+        self.sess.run(update_op, feed_dict=data_dict)
+        return self.sess.run(value)
+
+    @staticmethod
+    def _metric_names(metrics):
+        """Name each metric after its function, for the results of `evaluate`
+        and its ops' scopes. Metrics without a usable name (lambdas,
+        partials) get called 'metric_<index>', and names that are already
+        taken (including 'loss') get their index added"""
+
+        names = ['loss']
+        for idx, metric in enumerate(metrics):
+            name = getattr(metric, '__name__', '')
+            name = re.sub(r'[^A-Za-z0-9_.\-]', '_', name).lstrip('_') if name != '<lambda>' else ''
+            if not name:
+                name = 'metric_{}'.format(idx)
+            if name in names:
+                name = '{}_{}'.format(name, idx)
+            names.append(name)
+
+        return names[1:]
+
+    def _get_eval_ops(self, metrics):
+        """Get (or build, the first time) streaming ops for the loss and each
+        metric. Each is a (value, update_op, reset_op) triple, see
+        `losses.streaming_mean`. Per-batch metrics are turned into
+        streaming means weighted by the number of samples in each batch.
+
+        The ops are cached by the metrics' names (see `_metric_names`), so
+        a new lambda or partial on every call doesn't keep growing the graph.
+        That also means a different metric with the same name as one that's
+        already built (e.g. another lambda in the same position) gets the
+        first one's ops, so give distinct metrics distinct names"""
+
+        key = tuple(self._metric_names(metrics))
+        if key not in self._eval_ops:
+            with self.tf_mod.graph.as_default(), tf.variable_scope('evaluate'):
+                count = tf.to_float(tf.shape(self.tf_mod.inputs[0])[0])
+                eval_ops = {
+                    'loss': streaming_mean(self.tf_mod.loss, weights=count, name='loss')
+                }
+
+                for name, metric in zip(self._metric_names(metrics), metrics):
+                    results = [
+                        metric(*pair)
+                        for pair in zip(self.tf_mod.outputs, self.tf_mod.targets)
+                    ]
+
+                    if isinstance(results[0], tuple):
+                        eval_ops[name] = (
+                            tf.reduce_mean([value for value, _, _ in results]),
+                            tf.group(*[update for _, update, _ in results]),
+                            tf.group(*[reset for _, _, reset in results]),
+                        )
+                    else:
+                        eval_ops[name] = streaming_mean(
+                            tf.reduce_mean(results), weights=count, name=name
+                        )
+
+            self._eval_ops[key] = eval_ops
+
+        return self._eval_ops[key]
+
+    def evaluate(self, dataset_manager, metrics=None, batch_size=1024, num_prefetch=2):
+        """Measure the model's loss and some metrics over every sample in a
+        dataset manager. Batches are run inference-only and are prepared in a
+        background thread while the previous batch runs. The metrics are
+        accumulated in the graph and fetched once at the end, so the results
+        are exact means over every sample
+
+        Args:
+            dataset_manager: dataset manager with the samples to evaluate
+            metrics: list of metric functions that take (observed, actual)
+                layers and return either a per-batch mean (e.g.
+                `losses.accuracy`) or a streaming metric (e.g.
+                `losses.streaming_auc`). Metrics with the same names as
+                ones from an earlier call reuse their ops, see `_get_eval_ops`
+            batch_size: number of samples to run at once
+            num_prefetch: number of batches to prepare ahead of time
+
+        Returns:
+            dict with the mean 'loss' and the value of each metric, keyed by
+            the metric's function name (see `_metric_names`)
+        """
+
+        eval_ops = self._get_eval_ops(metrics or [])
+        values = {name: ops[0] for name, ops in eval_ops.items()}
+        update_ops = [ops[1] for ops in eval_ops.values()]
+        reset_ops = [ops[2] for ops in eval_ops.values()]
+
+        data_dicts = (
+            self.make_data_dict(x_batch, y_batch, is_training=False)
+            for x_batch, y_batch in dataset_manager.get_all_batches(batch_size=batch_size)
+        )
+
+        self.sess.run(reset_ops)
+        with contextlib.closing(prefetch(data_dicts, num_prefetch=num_prefetch)) as batches:
+            for data_dict in batches:
+                self.sess.run(update_ops, feed_dict=data_dict)
+
+        return self.sess.run(values)
+
+    def score_dataset(self, dataset_manager, batch_size=1024):
+        """Measure the model's mean loss over every sample in a dataset
+        manager, see `evaluate`"""
+
+        return self.evaluate(dataset_manager, batch_size=batch_size)['loss']
 
     def feature_importance(self, input_x, target_y, input_idxs=None, score_func=None):
         """Calculate feature importances"""
@@ -275,7 +655,8 @@ class ModelWrangler(object):
                 break
 
             data_dict = self.make_data_dict(train_in, train_out, is_training=True)
-            self.sess.run(self.tf_mod.train_step, feed_dict=data_dict)
+            self._run_train_step(data_dict, self.num_train_batches)
+            self.num_train_batches += 1
 
             if (batch_counter % train_save_interval) == 0:
                 self.save(batch_counter + offset)
@@ -283,35 +664,104 @@ class ModelWrangler(object):
             if train_verbose and ((batch_counter % train_verbose_interval) == 0):
 
                 # Write training stats to tensorboard
-                for name, writer in self.tf_mod.tb_writer['training'].items():
-                    writer.add_summary(
-                        self.sess.run(self.tf_mod.tb_stats, feed_dict=data_dict),
-                        batch_counter + offset
-                    )
-                train_error = self.score(train_in, train_out)
+                data_dict = self.make_data_dict(train_in, train_out, is_training=False)
+                train_error = self._write_tb_stats('training', data_dict, batch_counter + offset)
                 LOGGER.info("Batch %d: Training score = %0.6f", batch_counter, train_error)
 
                 ho_in, ho_out = next(self.holdout_gen)
                 data_dict = self.make_data_dict(ho_in, ho_out, is_training=False)
-                for name, writer in self.tf_mod.tb_writer['validation'].items():
-                    writer.add_summary(
-                        self.sess.run(self.tf_mod.tb_stats, feed_dict=data_dict),
-                        batch_counter + offset
-                    )
-                holdout_error = self.score(ho_in, ho_out)
+                holdout_error = self._write_tb_stats('validation', data_dict, batch_counter + offset)
                 LOGGER.info("Batch %d: Holdout score = %0.6f", batch_counter, holdout_error)
 
+        self._flush_accumulated_grads()
         self.save(batch_counter + offset)
 
+    def _write_tb_stats(self, phase, data_dict, step):
+        """Queue up a phase's tensorboard stats for a batch, and return the
+        loss that came along with them in the same `sess.run`"""
+
+        tb_stats, loss = self.sess.run(
+            [self.tf_mod.tb_stats, self.tf_mod.loss],
+            feed_dict=data_dict
+        )
+        self.tf_mod.tb_writer[phase].add_summary(tb_stats, step)
+        return loss
+
+    def _run_train_step(self, data_dict, step):
+        """Run a training step on a batch, or if the model accumulates
+        gradients, add the batch's gradients to the accumulators and only
+        apply them every `accumulate_steps` batches. Any metrics sinks that
+        are due to log at this step (the number of batches this wrangler
+        has trained on before this one) get their metrics from the same run"""
+
+        sinks = [
+            (sink, fetches) for sink, interval, fetches in self.metrics_sinks
+            if step % interval == 0
+        ]
+
+        if self.tf_mod.accumulate_step is None:
+            train_op = self.tf_mod.train_step
+        else:
+            train_op = self.tf_mod.accumulate_step
+
+        _, metrics = self.sess.run(
+            [train_op, [fetches for _, fetches in sinks]],
+            feed_dict=data_dict
+        )
+
+        for (sink, _), sink_metrics in zip(sinks, metrics):
+            sink.write(step, sink_metrics)
+
+        if self.tf_mod.accumulate_step is None:
+            return
+
+        self.num_accumulated += 1
+        if self.num_accumulated >= self.tf_mod.accumulate_steps:
+            self._flush_accumulated_grads()
+
+    def _flush_accumulated_grads(self):
+        """Apply any gradients waiting in the accumulators"""
+
+        if self.num_accumulated:
+            self.sess.run(self.tf_mod.train_step)
+            self.num_accumulated = 0
+
     def train(self):
         """
         Run a a bunch of training batches
         on the model using a bunch of input_x, target_y
+
+        If the training params have `'num_workers'` > 1, training is split
+        across that many local worker processes (see `_train_data_parallel`)
         """
+
+        num_workers = self.training_params.get('num_workers', 1)
+        if num_workers > 1:
+            # only fall back if the workers can't be set up, errors
+            # while they're training get raised
+            try:
+                cluster_spec, worker_args = prepare_data_parallel(
+                    self, num_workers,
+                    threads_per_worker=max(1, available_cpus() // num_workers)
+                )
+            except (OSError, pickle.PicklingError) as err:
+                LOGGER.warning(
+                    'Could not start data-parallel training (%s), '
+                    'falling back to a single process', err
+                )
+            else:
+                self._train_data_parallel(cluster_spec, worker_args)
+                return
+
         num_epochs = self.training_params.get('num_epochs', 1)
         epoch_length = self.training_params.get('epoch_length', None)
         batch_size = self.training_params.get('batch_size', 32)
         stride = self.training_params.get('stride', 1)
+        early_stopping = self.training_params.get('early_stopping', None)
+
+        self.best_score = np.inf
+        self.best_checkpoint = None
+        self.epochs_since_best = 0
 
         self.training_gen = self.training_data.get_next_batch(
             batch_size=batch_size, stride=stride, eternal=epoch_length is not None)
@@ -331,6 +781,10 @@ class ModelWrangler(object):
 
                 self._run_epoch(offset)
 
+                if early_stopping and self._should_stop_early(early_stopping):
+                    LOGGER.info('Stopping early after epoch %d', epoch)
+                    break
+
                 if not epoch_length:
                     self.training_gen = self.training_data.get_next_batch(
                         batch_size=batch_size, eternal=False)
@@ -342,18 +796,132 @@ class ModelWrangler(object):
         except KeyboardInterrupt:
             print('Force exiting training.')
 
+        for writer in self.tf_mod.tb_writer.values():
+            writer.flush()
+
+        for sink, _, _ in self.metrics_sinks:
+            sink.flush()
+
+        if early_stopping and early_stopping.get('restore_best', True) and self.best_checkpoint:
+            LOGGER.info('Restoring best weights from %s', self.best_checkpoint)
+            self.best_saver.restore(self.sess, self.best_checkpoint)
+
+    def _should_stop_early(self, early_stopping):
+        """Score the whole holdout set, keep a checkpoint of the best weights
+        so far and decide whether training has stopped improving
+
+        Args:
+            early_stopping: dict of early stopping params:
+                'patience' -> int, number of epochs without improvement
+                    before stopping, default = 3
+                'min_delta' -> float, how much the holdout score has to drop
+                    to count as an improvement, default = 0.0
+                'batch_size' -> int, batch size for scoring, default = 1024
+                'restore_best' -> bool, go back to the best weights at the
+                    end of training, default = True
+
+        Returns:
+            True if training should stop
+        """
+
+        holdout_score = self.score_dataset(
+            self.holdout_data, batch_size=early_stopping.get('batch_size', 1024)
+        )
+        LOGGER.info("Full holdout score = %0.6f", holdout_score)
+
+        if holdout_score < self.best_score - early_stopping.get('min_delta', 0.0):
+            self.best_score = holdout_score
+            self.epochs_since_best = 0
+            self._save_best()
+            return False
+
+        self.epochs_since_best += 1
+        return self.epochs_since_best >= early_stopping.get('patience', 3)
+
+    def _save_best(self):
+        """Checkpoint the best weights so far, separately from the regular
+        checkpoints so they don't get cleaned up"""
+
+        if self.best_saver is None:
+            with self.tf_mod.graph.as_default():
+                self.best_saver = tf.train.Saver(max_to_keep=1)
+
+        self.best_checkpoint = self.best_saver.save(
+            self.sess,
+            save_path=os.path.join(
+                self.model_params['path'],
+                '{}-best'.format(self.model_params['name'])
+            ),
+            latest_filename='best_checkpoint',
+            write_meta_graph=False
+        )
+
+    def _train_data_parallel(self, cluster_spec, worker_args):
+        """Train with the worker processes set up by `prepare_data_parallel`,
+        which each have their own session and shard of the training data,
+        and share weights through a localhost parameter server. Each worker
+        gets an equal share of the CPUs unless `intra_op_threads` is set in
+        the model params.
+
+        The training/holdout dataset managers need to be picklable (e.g.,
+        numpy arrays rather than generators) to be sent to the workers, and
+        scripts that use this need an `if __name__ == "__main__":` guard
+        """
+
+        run_data_parallel(cluster_spec, worker_args)
+        checkpoint = tf.train.latest_checkpoint(self.model_params['path'])
+
+        # pull the trained weights back into this process's session
+        if checkpoint:
+            self.model_params['meta_filename'] = checkpoint
+            self.tf_mod.saver.restore(self.sess, checkpoint)
+
+    def _get_tensor_index(self):
+        """Get a dict of op and tensor names -> tensors for the whole graph.
+        An op name maps to its first output. The index is built once and
+        only rebuilt if ops have been added to the graph since"""
+
+        graph = self.tf_mod.graph
+        if self._tensor_index_version != graph.version:
+            tensor_index = {}
+            for op in graph.get_operations():
+                for tensor in op.outputs:
+                    tensor_index[tensor.name] = tensor
+                if op.outputs:
+                    tensor_index[op.name] = op.outputs[0]
+
+            self._tensor_index = tensor_index
+            self._tensor_index_version = graph.version
+
+        return self._tensor_index
+
     def get_from_model(self, name_to_find, data_dict):
         """Return a piece of the model by it's name"""
 
-        if name_to_find not in self.tf_mod.graph._names_in_use:
-            raise KeyError('`{}` not in this model'.format(name_to_find))
+        return self.get_many_from_model([name_to_find], data_dict)[name_to_find]
 
-        ops_list = [i.name for i in self.tf_mod.graph.get_operations()]
-        if name_to_find in ops_list:
-            tensor_item = self.tf_mod.graph.get_tensor_by_name('{}:0'.format(name_to_find))
-        else:
-            tensor_item = self.tf_mod.graph.get_tensor_by_name(name_to_find)
+    def get_many_from_model(self, names_to_find, data_dict):
+        """Get the values of a bunch of pieces of the model in one `sess.run`
 
-        value_item = self.sess.run(tensor_item, feed_dict=data_dict)
-        return value_item
+        Args:
+            names_to_find: list of op or tensor names, e.g. `'params/coeff_0'`
+                or `'params/coeff_0:0'`
+            data_dict: feed dict, see `make_data_dict`
 
+        Returns:
+            dict of name -> value
+
+        Raises:
+            KeyError if a name isn't in the model
+        """
+
+        tensor_index = self._get_tensor_index()
+
+        missing = [name for name in names_to_find if name not in tensor_index]
+        if missing:
+            raise KeyError('`{}` not in this model'.format('`, `'.join(missing)))
+
+        return self.sess.run(
+            {name: tensor_index[name] for name in names_to_find},
+            feed_dict=data_dict
+        )
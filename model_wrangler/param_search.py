@@ -0,0 +1,339 @@
+"""Module implements parallel hyperparameter searches over ModelWrangler models
+
+Each trial is a set of model params that gets trained in its own process
+with a capped number of threads, so a multi-core machine can run many small
+trials at once. Params to search over are given as paths into the model
+params, e.g. `'graph/hidden_params'` or `'training/learning_rate'`.
+"""
+
+import os
+import sys
+import csv
+import json
+import random
+import logging
+import itertools
+import multiprocessing
+
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from model_wrangler.model_wrangler import ModelWrangler, available_cpus
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def param_grid(grid):
+    """Expand a dict of param paths -> lists of values into a list of
+    every combination of values
+
+    Args:
+        grid: dict like `{'training/learning_rate': [0.1, 0.01]}`
+
+    Returns:
+        list of dicts of param paths -> values
+    """
+
+    paths = sorted(grid)
+    return [
+        dict(zip(paths, values))
+        for values in itertools.product(*[grid[path] for path in paths])
+    ]
+
+
+def random_params(distributions, num_trials, seed=None):
+    """Randomly sample sets of params
+
+    Args:
+        distributions: dict of param paths -> either a list of values to
+            choose from or a function that takes a `random.Random` and
+            returns a value, e.g. `lambda rng: 10 ** rng.uniform(-4, -1)`
+        num_trials: number of param sets to sample
+        seed: random seed
+
+    Returns:
+        list of dicts of param paths -> values
+    """
+
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = {}
+        for path in sorted(distributions):
+            dist = distributions[path]
+            trial[path] = dist(rng) if callable(dist) else rng.choice(dist)
+        trials.append(trial)
+    return trials
+
+
+def set_param(params, path, value):
+    """Set a value in a nested params dict using a path like 'graph/num_units'"""
+
+    keys = path.split('/')
+    for key in keys[:-1]:
+        params = params.setdefault(key, {})
+    params[keys[-1]] = value
+
+
+def _median_says_stop(scoreboard, trial_idx, epoch, score, min_trials):
+    """Median stopping rule: stop a trial whose holdout score after an epoch
+    is worse than the median score of the other trials after that epoch"""
+
+    other_scores = [
+        val for (idx, ep), val in scoreboard.items()
+        if ep == epoch and idx != trial_idx
+    ]
+    if len(other_scores) < min_trials:
+        return False
+
+    return score > np.median(other_scores)
+
+
+def _run_trial(wrangler_class, model_class, model_params, training_params,
+               training_data, holdout_data, trial_idx, first_epoch, num_epochs,
+               scoreboard=None, min_trials=3):
+    """Train a single trial for some epochs, resuming from its last
+    checkpoint if it has already been trained, and return its results"""
+
+    model = wrangler_class(model_class, model_params)
+    if first_epoch > 0:
+        model.tf_mod.saver.restore(model.sess, tf.train.latest_checkpoint(model_params['path']))
+
+    model.add_data(training_data, holdout_data)
+    model.add_train_params(dict(training_params, num_epochs=1))
+
+    # a trial with no epochs left to run still reports the ones it has done
+    score = np.nan
+    stopped_early = False
+    epoch = first_epoch - 1
+    for epoch in range(first_epoch, first_epoch + num_epochs):
+        model.train()
+        score = model.score_dataset(holdout_data)
+
+        if scoreboard is not None:
+            scoreboard[(trial_idx, epoch)] = score
+            if _median_says_stop(scoreboard, trial_idx, epoch, score, min_trials):
+                stopped_early = True
+                break
+
+    return {
+        'score': score,
+        'epochs': epoch + 1,
+        'stopped_early': stopped_early,
+    }
+
+
+class ParamSearch(object):
+    """
+    Runs a hyperparameter search over a model in a pool of processes:
+        `grid_search`: try every combination of some param values
+        `random_search`: try randomly sampled param values
+        `successive_halving`: train everything a little, then keep training
+            only the best fraction of trials with more and more epochs
+    """
+
+    def __init__(self, model_class, model_params, training_data, holdout_data,
+                 training_params=None, num_processes=None, threads_per_trial=1,
+                 results_file=None, wrangler_class=None):
+        """
+        Args:
+          model_class: architecture class to search over
+          model_params: base model params that each trial modifies. Each trial
+            gets its own `name` and `path` based on these
+          training_data: dataset manager for training
+          holdout_data: dataset manager used to score each trial
+          training_params: training params passed to `add_train_params`,
+            `num_epochs` is set by the search instead
+          num_processes: number of trials to run at once, defaults to the
+            number of available CPUs divided by `threads_per_trial`
+          threads_per_trial: intra-op threads for each trial's session
+          results_file: CSV file to write the results table to
+          wrangler_class: ModelWrangler subclass to use instead of ModelWrangler
+        """
+
+        self.wrangler_class = wrangler_class or ModelWrangler
+        self.model_class = model_class
+        self.model_params = {
+            key: val for key, val in model_params.items()
+            if key != 'model_class'
+        }
+        self.training_data = training_data
+        self.holdout_data = holdout_data
+        self.training_params = training_params or {}
+        self.threads_per_trial = threads_per_trial
+        self.num_processes = num_processes or max(1, available_cpus() // threads_per_trial)
+        self.results_file = results_file
+
+    def _trial_params(self, trial_idx, trial):
+        """Make the model params for a trial"""
+
+        params = deepcopy(self.model_params)
+        for path, value in trial.items():
+            set_param(params, path, value)
+
+        params['name'] = '{}_trial_{}'.format(self.model_params['name'], trial_idx)
+        params['path'] = os.path.join(self.model_params['path'], 'trial_{}'.format(trial_idx))
+        params['intra_op_threads'] = self.threads_per_trial
+        params['inter_op_threads'] = 1
+        return params
+
+    def _run_trials(self, trials, first_epochs, num_epochs, scoreboard=None, min_trials=3):
+        """Run a round of trials in the process pool
+
+        Args:
+            trials: dict of trial index -> dict of param paths -> values
+            first_epochs: dict of trial index -> number of epochs it already ran
+            num_epochs: number of epochs to train each trial for
+            scoreboard: shared dict for the median stopping rule, or None
+
+        Returns:
+            dict of trial index -> results dict
+        """
+
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.num_processes, mp_context=ctx) as pool:
+            futures = {
+                trial_idx: pool.submit(
+                    _run_trial,
+                    self.wrangler_class, self.model_class,
+                    self._trial_params(trial_idx, trial), self.training_params,
+                    self.training_data, self.holdout_data,
+                    trial_idx, first_epochs.get(trial_idx, 0), num_epochs,
+                    scoreboard, min_trials
+                )
+                for trial_idx, trial in trials.items()
+            }
+
+            results = {}
+            for trial_idx, future in futures.items():
+                results[trial_idx] = future.result()
+                LOGGER.info(
+                    'Trial %d: holdout score = %0.6f after %d epochs',
+                    trial_idx, results[trial_idx]['score'], results[trial_idx]['epochs']
+                )
+
+        return results
+
+    def _make_table(self, trials, results):
+        """Put the results in a list of rows sorted by score (best first)
+        and write them to the results file"""
+
+        table = [
+            dict(
+                trial=trial_idx,
+                params=trials[trial_idx],
+                **results[trial_idx]
+            )
+            for trial_idx in trials
+        ]
+        table.sort(key=lambda row: np.inf if np.isnan(row['score']) else row['score'])
+
+        if self.results_file:
+            with open(self.results_file, 'w', newline='') as file:
+                writer = csv.DictWriter(
+                    file, fieldnames=['trial', 'score', 'epochs', 'stopped_early', 'params']
+                )
+                writer.writeheader()
+                for row in table:
+                    writer.writerow(dict(row, params=json.dumps(row['params'], default=str)))
+
+        return table
+
+    def search(self, trials, num_epochs=1, early_stopping=True, min_trials=3):
+        """Train every trial for `num_epochs`, early-killing trials whose
+        holdout score falls below the median of the others
+
+        Args:
+            trials: list of dicts of param paths -> values
+            num_epochs: max epochs to train each trial for
+            early_stopping: stop losing trials with the median stopping rule
+            min_trials: number of other trials that need to report a score
+                for an epoch before any trial can be stopped at that epoch
+
+        Returns:
+            list of results dicts (trial, params, score, epochs, stopped_early)
+            sorted from best to worst holdout score
+        """
+
+        trials = dict(enumerate(trials))
+
+        if early_stopping:
+            with multiprocessing.get_context('spawn').Manager() as manager:
+                results = self._run_trials(
+                    trials, {}, num_epochs, scoreboard=manager.dict(), min_trials=min_trials
+                )
+        else:
+            results = self._run_trials(trials, {}, num_epochs)
+
+        return self._make_table(trials, results)
+
+    def grid_search(self, grid, **kwargs):
+        """Search over every combination of values in a grid, see `param_grid`
+        and `search` for the arguments"""
+
+        return self.search(param_grid(grid), **kwargs)
+
+    def random_search(self, distributions, num_trials, seed=None, **kwargs):
+        """Search over random samples of params, see `random_params`
+        and `search` for the arguments"""
+
+        return self.search(random_params(distributions, num_trials, seed=seed), **kwargs)
+
+    def successive_halving(self, trials, min_epochs=1, max_epochs=27, reduction_factor=3):
+        """Successive halving: train every trial for `min_epochs`, keep the best
+        1 / `reduction_factor` of them, and keep training the survivors for
+        `reduction_factor` times as many epochs until `max_epochs` is reached
+        or one trial is left. Survivors resume from their checkpoints
+
+        Args:
+            trials: list of dicts of param paths -> values
+            min_epochs: epochs that every trial gets trained for
+            max_epochs: total epochs for the trials that make it to the end
+            reduction_factor: fraction of trials killed in each round
+
+        Returns:
+            list of results dicts (trial, params, score, epochs, stopped_early)
+            sorted from best to worst holdout score
+        """
+
+        # a zero-epoch round would never grow the budget
+        if min_epochs < 1:
+            raise ValueError('`min_epochs` must be at least 1')
+
+        trials = dict(enumerate(trials))
+        results = {}
+
+        survivors = list(trials)
+        done_epochs, total_epochs = 0, min_epochs
+        while True:
+            # survivors pick up where they left off and train up to this round's budget
+            results.update(self._run_trials(
+                {idx: trials[idx] for idx in survivors},
+                {idx: done_epochs for idx in survivors},
+                total_epochs - done_epochs
+            ))
+
+            if len(survivors) <= 1 or total_epochs >= max_epochs:
+                break
+
+            ranked = sorted(
+                survivors,
+                key=lambda idx: np.inf if np.isnan(results[idx]['score']) else results[idx]['score']
+            )
+            num_keep = max(1, len(ranked) // reduction_factor)
+            for idx in ranked[num_keep:]:
+                results[idx]['stopped_early'] = True
+
+            survivors = ranked[:num_keep]
+            done_epochs, total_epochs = total_epochs, min(total_epochs * reduction_factor, max_epochs)
+
+        return self._make_table(trials, results)
@@ -5,6 +5,8 @@
 # pylint: disable=C0325
 # pylint: disable=E1101
 
+from copy import deepcopy
+
 import numpy as np
 from scipy.stats import zscore
 
@@ -162,6 +164,31 @@ def test_conv_ae():
     print('\tpost-score: {}'.format(ae_model.score([X], [X])))
 
 
+def test_conv_ae_accumulate():
+    """Test convolutional autoencoder with gradient accumulation"""
+
+    params = deepcopy(CONV_PARAMS)
+    params['name'] = 'test_ae_conv_accum'
+    params['path'] = './tests/test_ae_conv_accum'
+    params['training'] = {'accumulate_steps': 4}
+
+    X = make_timeseries_testdata(in_dim=params['graph']['in_sizes'][0][0])
+    X = X[:, :, np.newaxis]
+
+    ae_model = ModelWrangler(ConvolutionalAutoencoderModel, params)
+    assert ae_model.tf_mod.accumulate_step is not None
+
+    dm1 = DatasetManager([X], [X])
+    dm2 = DatasetManager([X], [X])
+    ae_model.add_data(dm1, dm2)
+
+    pre_score = ae_model.score([X], [X])
+    ae_model.train()
+    post_score = ae_model.score([X], [X])
+    assert pre_score != post_score
+    assert ae_model.num_accumulated == 0
+
+
 if __name__ == "__main__":
 
     print('\n\nunit testing dense autoencoder')
@@ -179,3 +206,6 @@ if __name__ == "__main__":
 
     print("\n\ne2e testing convolutional autoencoder")
     test_conv_ae()
+
+    print("\n\ne2e testing convolutional autoencoder with gradient accumulation")
+    test_conv_ae_accumulate()
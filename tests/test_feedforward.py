@@ -5,14 +5,25 @@
 # pylint: disable=E1101
 
 
+import os
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
+from types import SimpleNamespace
+
 import numpy as np
+import tensorflow as tf
 from scipy.stats import zscore
 
 from model_wrangler.model_wrangler import ModelWrangler
 from model_wrangler.dataset_managers import DatasetManager
+from model_wrangler.metrics_sinks import RingBufferSink, FileSink
 
 
-from model_wrangler.model.losses import accuracy
+from model_wrangler.model.losses import accuracy, streaming_accuracy
+from model_wrangler.model.layers import append_conv_bn_block
 
 from model_wrangler.model.corral.dense_feedforward import DenseFeedforwardModel
 from model_wrangler.model.corral.convolutional_feedforward import ConvolutionalFeedforwardModel
@@ -158,6 +169,166 @@ def test_dense_ff(num_out_cats=5):
     print("Acc'y: {}".format(ff_model.score([X], [y], score_func=accuracy)))
 
 
+def test_dense_ff_evaluate(num_out_cats=5):
+    """Test batched evaluation over a whole dataset manager"""
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, DENSE_PARAMS)
+
+    in_dim = DENSE_PARAMS['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    results = ff_model.evaluate(
+        DatasetManager([X], [y]), metrics=[accuracy, streaming_accuracy], batch_size=64
+    )
+    print(results)
+
+    assert set(results) == {'loss', 'accuracy', 'streaming_accuracy'}
+    assert np.isclose(
+        results['accuracy'],
+        ff_model.score([X], [y], score_func=accuracy),
+        rtol=1e-5
+    )
+
+    # metrics without a usable name
+    lambda_acc = ff_model.score([X], [y], score_func=lambda obs, act: accuracy(obs, act))
+    assert np.isclose(results['accuracy'], lambda_acc, rtol=1e-5)
+
+    results = ff_model.evaluate(
+        DatasetManager([X], [y]),
+        metrics=[lambda obs, act: accuracy(obs, act), partial(accuracy), lambda obs, act: 0.0 * accuracy(obs, act)],
+        batch_size=64
+    )
+    assert set(results) == {'loss', 'metric_0', 'metric_1', 'metric_2'}
+    assert np.isclose(results['metric_0'], results['metric_1'], rtol=1e-5)
+    assert results['metric_2'] == 0.0
+
+    # a new lambda with the same name reuses the ops built for the old one
+    num_ops = len(ff_model.tf_mod.graph.get_operations())
+    ff_model.score([X], [y], score_func=lambda obs, act: accuracy(obs, act))
+    assert len(ff_model.tf_mod.graph.get_operations()) == num_ops
+
+
+def test_dense_ff_metrics_sinks(num_out_cats=5):
+    """Test logging metrics from the training step to sinks"""
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, DENSE_PARAMS)
+
+    in_dim = DENSE_PARAMS['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    ring_sink = RingBufferSink()
+    file_sink = FileSink(DENSE_PARAMS['path'] + '/metrics.jsonl', buffer_size=4)
+    ff_model.add_metrics_sink(ring_sink, interval=2, scalars=['embed_mean'])
+    ff_model.add_metrics_sink(file_sink, interval=5)
+
+    ff_model.add_data(DatasetManager([X], [y]), DatasetManager([X], [y]))
+    ff_model.add_train_params({'num_epochs': 2, 'batch_size': 8, 'verbose': False})
+    ff_model.train()
+
+    steps, losses = ring_sink.values('loss')
+    print(losses)
+
+    # steps keep counting across epochs
+    assert list(steps) == list(range(0, ff_model.num_train_batches, 2))
+    assert len(ring_sink.values('embed_mean')[1]) == len(losses)
+    assert np.all(np.isfinite(losses))
+    assert not file_sink.buffer
+
+
+def test_dense_ff_graph_cache(num_out_cats=5):
+    """Test that a second identical model gets its graph from the cache"""
+
+    params = deepcopy(DENSE_PARAMS)
+    params['graph_cache'] = tempfile.mkdtemp(prefix='graph_cache_')
+
+    in_dim = params['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, deepcopy(params))
+    assert not ff_model.tf_mod.graph_from_cache
+
+    cache_filename = ff_model.tf_mod._graph_cache_filename(params)
+    assert os.path.exists(cache_filename + '.meta')
+
+    cached_model = ModelWrangler(DenseFeedforwardModel, deepcopy(params))
+    assert cached_model.tf_mod.graph_from_cache
+
+    assert set(cached_model.tf_mod.tb_scalars) == set(ff_model.tf_mod.tb_scalars)
+    assert cached_model.predict([X])[0].shape == ff_model.predict([X])[0].shape
+
+    cached_model.add_data(DatasetManager([X], [y]), DatasetManager([X], [y]))
+    cached_model.add_train_params({'num_epochs': 1, 'batch_size': 8, 'verbose': False})
+    cached_model.train()
+    assert np.isfinite(cached_model.score([X], [y]))
+
+
+def _train_xla_jit(xla_jit, num_out_cats=5):
+    """Train a model with XLA JIT, and return its JIT level, the number of
+    ops marked for scoped compilation, the number of XLA ops that ran in a
+    training step, and its loss. This needs a fresh process, since TF only
+    reads its XLA flags once per process"""
+
+    in_dim = DENSE_PARAMS['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    params = deepcopy(DENSE_PARAMS)
+    params['xla_jit'] = xla_jit
+    ff_model = ModelWrangler(DenseFeedforwardModel, params)
+
+    ff_model.add_data(DatasetManager([X], [y]), DatasetManager([X], [y]))
+    ff_model.add_train_params({'num_epochs': 1, 'batch_size': 8, 'verbose': False})
+    ff_model.train()
+
+    run_metadata = tf.RunMetadata()
+    ff_model.sess.run(
+        ff_model.tf_mod.train_step,
+        feed_dict=ff_model.make_data_dict([X[:8]], [y[:8]], is_training=True),
+        options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+        run_metadata=run_metadata
+    )
+
+    # compiled clusters run as `_XlaRun`/`XlaLaunch` ops named `cluster_*`
+    xla_ops = [
+        node_stats.node_name
+        for dev_stats in run_metadata.step_stats.dev_stats
+        for node_stats in dev_stats.node_stats
+        if 'Xla' in node_stats.timeline_label or node_stats.node_name.startswith('cluster_')
+    ]
+    marked_ops = [
+        op for op in ff_model.tf_mod.graph.get_operations()
+        if '_XlaCompile' in op.node_def.attr
+    ]
+
+    jit_level = ff_model.session_params.graph_options.optimizer_options.global_jit_level
+    return jit_level, len(marked_ops), len(xla_ops), float(ff_model.score([X], [y]))
+
+
+def test_dense_ff_xla_jit():
+    """Test that both XLA JIT modes compile ops, and that a session-wide
+    JIT doesn't turn on XLA for models built later without it"""
+
+    ctx = multiprocessing.get_context('spawn')
+    for xla_jit in ['session', 'scoped']:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            jit_level, num_marked, num_xla_ops, loss = executor.submit(
+                _train_xla_jit, xla_jit
+            ).result()
+
+        if xla_jit == 'session':
+            assert jit_level == tf.OptimizerOptions.ON_1
+            assert not num_marked
+        else:
+            assert jit_level != tf.OptimizerOptions.ON_1
+            assert num_marked
+
+        assert num_xla_ops
+        assert np.isfinite(loss)
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, deepcopy(DENSE_PARAMS))
+    jit_level = ff_model.session_params.graph_options.optimizer_options.global_jit_level
+    assert jit_level != tf.OptimizerOptions.ON_1
+
+
 def test_conv_ff(in_dim=15, num_out_cats=5):
     """Test dense feedforward"""
 
@@ -178,6 +349,157 @@ def test_conv_ff(in_dim=15, num_out_cats=5):
     print("Acc'y: {}".format(ff_model.score([X], [y], score_func=accuracy)))
 
 
+def test_conv_ff_fused_block(num_out_cats=5):
+    """Test conv feedforward built from fused conv/batchnorm blocks"""
+
+    params = deepcopy(CONV_PARAMS)
+    params['name'] = 'test_ff_conv_fused'
+    params['path'] = './tests/test_ff_conv_fused'
+    for layer_param in params['graph']['hidden_params']:
+        layer_param['fused_block'] = True
+
+    ff_model = ModelWrangler(ConvolutionalFeedforwardModel, params)
+
+    in_dim = params['graph']['in_sizes'][0][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+    X = X[..., np.newaxis]
+
+    dm1 = DatasetManager([X], [y])
+    dm2 = DatasetManager([X], [y])
+    ff_model.add_data(dm1, dm2)
+
+    print("Loss: {}".format(ff_model.score([X], [y])))
+    ff_model.train()
+    print("Loss: {}".format(ff_model.score([X], [y])))
+
+
+def test_conv_ff_separable(num_out_cats=5):
+    """Test conv feedforward built from separable convolutions on 1D and 2D
+    inputs, and that 3D inputs get refused"""
+
+    for in_size in [[10, 1], [10, 10, 1]]:
+        params = deepcopy(CONV_PARAMS)
+        params['name'] = 'test_ff_conv_separable'
+        params['path'] = './tests/test_ff_conv_separable'
+        params['graph']['in_sizes'] = [in_size]
+        for layer_param in params['graph']['hidden_params']:
+            layer_param['separable'] = True
+
+        ff_model = ModelWrangler(ConvolutionalFeedforwardModel, params)
+
+        X, y = make_testdata(in_dim=int(np.prod(in_size)), num_out_cats=num_out_cats)
+        X = X.reshape([-1] + in_size)
+
+        dm1 = DatasetManager([X], [y])
+        dm2 = DatasetManager([X], [y])
+        ff_model.add_data(dm1, dm2)
+
+        ff_model.train()
+        assert np.isfinite(ff_model.score([X], [y]))
+
+    params['graph']['in_sizes'] = [[4, 4, 4, 1]]
+    try:
+        ModelWrangler(ConvolutionalFeedforwardModel, params)
+    except ValueError:
+        pass
+    else:
+        assert False, 'separable 3D convolutions should raise a ValueError'
+
+
+def test_conv_bn_block_folding(in_dim=15, batch_size=8):
+    """Test that the folded inference path of a fused conv/batchnorm block
+    matches conv -> batch norm with the moving statistics"""
+
+    layer_param = {'num_units': 4, 'kernel': 3, 'strides': 1, 'activation': 'relu'}
+    X = np.random.randn(batch_size, in_dim, 1).astype(np.float32)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        architecture = SimpleNamespace(is_training=tf.placeholder("bool"))
+        in_layer = tf.placeholder("float", shape=[None, in_dim, 1])
+        block = append_conv_bn_block(architecture, in_layer, layer_param, 'conv_block')
+
+        with tf.variable_scope('conv_block', reuse=True):
+            kernel, gamma, beta, moving_mean, moving_variance = [
+                tf.get_variable(name)
+                for name in ['kernel', 'gamma', 'beta', 'moving_mean', 'moving_variance']
+            ]
+
+        reference = tf.nn.relu(tf.nn.batch_normalization(
+            tf.nn.convolution(in_layer, kernel, 'SAME', strides=[1]),
+            moving_mean, moving_variance, beta, gamma, 1.0e-3
+        ))
+
+        num_units = layer_param['num_units']
+        randomize_stats = [
+            gamma.assign(np.random.uniform(0.5, 2.0, num_units)),
+            beta.assign(np.random.randn(num_units)),
+            moving_mean.assign(np.random.randn(num_units)),
+            moving_variance.assign(np.random.uniform(0.5, 2.0, num_units)),
+        ]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(randomize_stats)
+            folded, unfolded = sess.run(
+                [block, reference],
+                feed_dict={in_layer: X, architecture.is_training: False}
+            )
+
+    assert folded.shape == (batch_size, in_dim, num_units)
+    assert np.allclose(folded, unfolded, rtol=1e-4, atol=1e-5)
+
+
+def test_dense_ff_data_parallel(num_out_cats=5):
+    """Test dense feedforward model trained by 2 worker processes"""
+
+    params = deepcopy(DENSE_PARAMS)
+    params['name'] = 'test_ff_dense_parallel'
+    params['path'] = './tests/test_ff_dense_parallel'
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, params)
+
+    in_dim = params['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    dm1 = DatasetManager([X], [y])
+    dm2 = DatasetManager([X], [y])
+    ff_model.add_data(dm1, dm2)
+    ff_model.add_train_params({'num_workers': 2, 'num_epochs': 2})
+
+    pre_score = ff_model.score([X], [y])
+    ff_model.train()
+    post_score = ff_model.score([X], [y])
+    print("Loss: {} -> {}".format(pre_score, post_score))
+    assert pre_score != post_score
+
+
+def test_dense_ff_early_stopping(num_out_cats=5):
+    """Test dense feedforward model with early stopping on the full holdout set"""
+
+    params = deepcopy(DENSE_PARAMS)
+    params['name'] = 'test_ff_dense_early'
+    params['path'] = './tests/test_ff_dense_early'
+
+    ff_model = ModelWrangler(DenseFeedforwardModel, params)
+
+    in_dim = params['graph']['in_sizes'][0]
+    X, y = make_testdata(in_dim=in_dim, num_out_cats=num_out_cats)
+
+    dm1 = DatasetManager([X], [y])
+    dm2 = DatasetManager([X], [y])
+    ff_model.add_data(dm1, dm2)
+    ff_model.add_train_params({
+        'num_epochs': 50,
+        'verbose': False,
+        'early_stopping': {'patience': 2, 'min_delta': 1e-3},
+    })
+
+    ff_model.train()
+    assert ff_model.best_checkpoint is not None
+    assert np.isclose(ff_model.score_dataset(dm2), ff_model.best_score, rtol=1e-4)
+
+
 def test_diebias_ff(num_out_cats=5):
     """Test debiased feedforward model"""
 
@@ -13,6 +13,8 @@ from sklearn.linear_model import LinearRegression as sk_LinearRegression
 
 from model_wrangler.model_wrangler import ModelWrangler
 from model_wrangler.dataset_managers import DatasetManager
+from model_wrangler.param_search import ParamSearch
+from model_wrangler.cross_validation import cross_validate
 
 from model_wrangler.model.corral.linear_regression import LinearRegressionModel
 from model_wrangler.model.corral.logistic_regression import LogisticRegressionModel
@@ -82,6 +84,10 @@ def compare_scikt_and_tf(sk_model, tf_model, X, y, sk_params={}):
     data_dict = tf_model.make_data_dict([X], [y], is_training=False)
     tf_coef = tf_model.get_from_model('params/coeff_0', data_dict)
     tf_int = tf_model.get_from_model('params/intercept_0', data_dict)
+
+    tf_params = tf_model.get_many_from_model(['params/coeff_0', 'params/intercept_0:0'], data_dict)
+    assert np.allclose(tf_params['params/coeff_0'], tf_coef)
+    assert np.allclose(tf_params['params/intercept_0:0'], tf_int)
     print('\t coef: {}'.format(tf_coef.ravel()))
     print('\t int: {}'.format(tf_int.ravel()))
 
@@ -120,6 +126,41 @@ def test_logistic_regr():
         ModelWrangler(LogisticRegressionModel, LOGISTIC_PARAMS),
         X, y)
 
+def test_linear_param_search():
+    """Grid search over the linear regression learning rate"""
+
+    X, y = make_linear_reg_testdata(in_dim=LINEAR_PARAMS['graph']['in_sizes'][0])
+
+    search = ParamSearch(
+        LinearRegressionModel, LINEAR_PARAMS,
+        DatasetManager([X], [y]), DatasetManager([X], [y]),
+        training_params={'verbose': False},
+        num_processes=2,
+        results_file='./tests/test_lin_search.csv'
+    )
+    results = search.grid_search(
+        {'training/learning_rate': [0.1, 0.01, 0.001]},
+        num_epochs=2, early_stopping=False
+    )
+
+    assert len(results) == 3
+    assert results[0]['score'] <= results[-1]['score']
+    print(results)
+
+def test_linear_cross_validate():
+    """Cross-validate linear regression"""
+
+    X, y = make_linear_reg_testdata(in_dim=LINEAR_PARAMS['graph']['in_sizes'][0])
+
+    results = cross_validate(
+        LinearRegressionModel, LINEAR_PARAMS, DatasetManager([X], [y]),
+        num_folds=3, training_params={'verbose': False}, num_processes=3, seed=0
+    )
+
+    assert len(results['fold_scores']) == 3
+    assert sum(results['fold_sizes']) == X.shape[0]
+    print(results)
+
 if __name__ == "__main__":
 
     print("\n\nunit testing linear regression")
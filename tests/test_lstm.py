@@ -5,6 +5,8 @@
 # pylint: disable=E1101
 
 
+from copy import deepcopy
+
 import numpy as np
 
 import numpy as np
@@ -121,6 +123,162 @@ def test_lstm_text():
     lstm_model.train()
     print("Loss: {}".format(lstm_model.score(*xy_test)))
 
+    generated = lstm_model.tf_mod.generate(lstm_model.sess, xy_test[0][0][:4], 20)
+    assert len(generated) == 4
+    assert all(len(gen) == 20 for gen in generated)
+
+    beams, scores = lstm_model.tf_mod.beam_search(lstm_model.sess, xy_test[0][0][:4], 20)
+    assert len(beams) == 4
+    assert scores.shape == (4, lstm_model.tf_mod.beam_output.get_shape().as_list()[-1])
+    assert all(len(beam) == 20 for row in beams for beam in row)
+
+def test_lstm_text_beam_search(num_prompts=3, num_chars=7):
+    """Test the shape of beam search output from an untrained model"""
+
+    lstm_model = ModelWrangler(TextLstmModel, LSTM_TEXT_PARAMS)
+    beam_width = lstm_model.tf_mod.beam_output.get_shape().as_list()[-1]
+
+    prompts = ['the quick brown fox', 'jumped over', 'a']
+    beams, scores = lstm_model.tf_mod.beam_search(lstm_model.sess, prompts, num_chars)
+
+    assert beam_width == LSTM_TEXT_PARAMS['graph'].get('beam_width', 4)
+    assert len(beams) == num_prompts
+    assert all(len(row) == beam_width for row in beams)
+    assert all(len(beam) == num_chars for row in beams for beam in row)
+    assert scores.shape == (num_prompts, beam_width)
+
+    # beams come out best first
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+def test_lstm_fused():
+    """Test numeric and text LSTMs built from fused kernels"""
+
+    params = deepcopy(LSTM_PARAMS)
+    params['graph']['fused_lstm'] = True
+
+    X = make_numeric_testdata(n_samp=100)
+    dm = SequentialDatasetManager(
+        X,
+        in_win_len=params['graph']['in_sizes'][0][0],
+        out_win_len=params['graph']['out_sizes'][0],
+        cache_size=128
+    )
+
+    lstm_model = ModelWrangler(LstmModel, params)
+    lstm_model.add_data(dm, dm)
+    lstm_model.train()
+
+    xy_test = next(dm.get_next_batch(batch_size=128))
+    assert np.isfinite(lstm_model.score(*xy_test))
+
+    text_params = deepcopy(LSTM_TEXT_PARAMS)
+    text_params['graph']['fused_lstm'] = True
+
+    X = make_text_testdata(n_samp=100)
+    dm = SequentialDatasetManager(
+        X,
+        in_win_len=text_params['graph']['win_length'],
+        out_win_len=1,
+        cache_size=128
+    )
+
+    lstm_model = ModelWrangler(TextLstmModel, text_params)
+    lstm_model.add_data(dm, dm)
+    lstm_model.train()
+
+    xy_test = next(dm.get_next_batch(batch_size=128))
+    assert np.isfinite(lstm_model.score(*xy_test))
+
+    generated = lstm_model.tf_mod.generate(lstm_model.sess, xy_test[0][0][:4], 20)
+    assert len(generated) == 4
+    assert all(len(gen) == 20 for gen in generated)
+
+    beams, scores = lstm_model.tf_mod.beam_search(lstm_model.sess, xy_test[0][0][:4], 20)
+    assert len(beams) == 4
+    assert all(len(beam) == 20 for row in beams for beam in row)
+    assert np.isfinite(scores).all()
+
+def test_lstm_bidirectional():
+    """Test bidirectional LSTMs built from fused and cuDNN-compatible cells"""
+
+    X = make_numeric_testdata(n_samp=100)
+
+    for fused_lstm in [True, False]:
+        params = deepcopy(LSTM_PARAMS)
+        params['graph']['bidirectional'] = True
+        params['graph']['fused_lstm'] = fused_lstm
+
+        dm = SequentialDatasetManager(
+            X,
+            in_win_len=params['graph']['in_sizes'][0][0],
+            out_win_len=params['graph']['out_sizes'][0],
+            cache_size=128
+        )
+
+        lstm_model = ModelWrangler(LstmModel, params)
+        lstm_model.add_data(dm, dm)
+        lstm_model.train()
+
+        xy_test = next(dm.get_next_batch(batch_size=128))
+        assert np.isfinite(lstm_model.score(*xy_test))
+
+def test_lstm_text_skip_padding():
+    """Test that left-padding doesn't change the LSTM output/state when
+    skipping padding, and that padding gets no weight in the loss"""
+
+    params = deepcopy(LSTM_TEXT_PARAMS)
+    params['graph']['skip_padding'] = True
+
+    lstm_model = ModelWrangler(TextLstmModel, params)
+    tf_mod = lstm_model.tf_mod
+    text_map = tf_mod.text_map
+
+    strings = ['hello', 'hi there', 'a']
+    unpadded = [text_map.strings_to_array([string], use_pad=False) for string in strings]
+
+    # extra padding on the left of every row
+    padded = np.full(
+        (len(strings), max(ints.shape[1] for ints in unpadded) + 3),
+        text_map.pad_char_idx, dtype=np.int32
+    )
+    for row, ints in zip(padded, unpadded):
+        row[-ints.shape[1]:] = ints[0]
+
+    state_in = [tensor for layer_state in tf_mod.gen_state_in for tensor in layer_state]
+    state_out = [tensor for layer_state in tf_mod.gen_state_out for tensor in layer_state]
+
+    def _run_state(in_ints, lengths):
+        data_dict = {
+            tf_mod.gen_input: in_ints,
+            tf_mod.gen_length: lengths,
+            tf_mod.is_training: False
+        }
+        data_dict.update({
+            tensor: np.zeros((len(in_ints), tensor.get_shape().as_list()[-1]))
+            for tensor in state_in
+        })
+        return lstm_model.sess.run(state_out, feed_dict=data_dict)
+
+    padded_state = _run_state(padded, [ints.shape[1] for ints in unpadded])
+    for idx, ints in enumerate(unpadded):
+        # the last layer's `h` is the output at the last step
+        unpadded_state = _run_state(ints, [ints.shape[1]])
+        for padded_val, unpadded_val in zip(padded_state, unpadded_state):
+            assert np.allclose(padded_val[idx], unpadded_val[0], atol=1e-5)
+
+    # predictions made from padding positions get zero loss weight
+    win_length = params['graph']['win_length']
+    loss_weights = lstm_model.get_from_model(
+        'loss_weights:0',
+        lstm_model.make_data_dict([strings], None, is_training=False)
+    )
+    in_ints = text_map.strings_to_array(strings)
+    num_chars = win_length - np.cumprod(in_ints == text_map.pad_char_idx, axis=1).sum(axis=1)
+    assert loss_weights.shape == (len(strings), win_length - 1)
+    for row, row_chars in zip(loss_weights, num_chars):
+        assert not row[:win_length - row_chars].any()
+        assert row[win_length - row_chars:].all()
+
 if __name__ == "__main__":
     """
     print("\n\n LSTM unit tests")
@@ -7,12 +7,14 @@
 
 
 import numpy as np
+import tensorflow as tf
 from nltk.corpus import brown
 
 from model_wrangler.model_wrangler import ModelWrangler
 from model_wrangler.dataset_managers import DatasetManager
 
 from model_wrangler.model.losses import accuracy
+from model_wrangler.model.text_tools import TextProcessor
 
 from model_wrangler.model.corral.text_classification import TextClassificationModel
 
@@ -74,6 +76,97 @@ def make_testdata(out_dim=3, num_samples=100):
     return X, y
 
 
+def test_text_processor_batch():
+    """Test batch string encoding matches the per-string encoding"""
+
+    text_map = TextProcessor(pad_len=8)
+    strings = ['abc', 'hello world', u'caf\u00e9', '', b'xyz']
+
+    int_array = text_map.strings_to_array(strings)
+    assert int_array.shape == (len(strings), 8)
+    assert int_array.dtype == np.int32
+
+    for row, in_string in zip(int_array, strings):
+        assert list(row) == text_map.string_to_ints(in_string)
+
+    assert list(int_array[0, -3:]) == [text_map.char_to_int[c] for c in 'abc']
+    assert (int_array[3] == text_map.pad_char_idx).all()
+
+
+def test_text_processor_decode():
+    """Test batch decoding of ints back to strings"""
+
+    text_map = TextProcessor(pad_len=8)
+    strings = ['abc', 'hello wo', 'a?b']
+
+    decoded = text_map.ints_to_strings(text_map.strings_to_array(strings))
+    assert decoded == [in_string.rjust(8) for in_string in strings]
+    assert text_map.ints_to_string(text_map.string_to_ints('abc')) == '     abc'
+
+
+def test_text_processor_cache():
+    """Test the LRU cache of encoded strings"""
+
+    text_map = TextProcessor(pad_len=8, cache_size=2)
+    uncached = TextProcessor(pad_len=8)
+
+    strings = ['abc', 'def', 'abc', 'ghi', 'def']
+    assert (text_map.strings_to_array(strings) == uncached.strings_to_array(strings)).all()
+
+    cache_info = text_map.cache_info()
+    assert cache_info['hits'] == 1
+    assert cache_info['misses'] == 4
+    assert cache_info['size'] == 2
+
+    text_map.clear_cache()
+    assert text_map.cache_info()['size'] == 0
+
+
+def test_text_encode_in_graph():
+    """Test that in-graph string encoding matches the py_func encoding"""
+
+    ff_model = ModelWrangler(TextClassificationModel, CONV_PARAMS)
+    tf_mod = ff_model.tf_mod
+    pad_len = tf_mod.text_map.pad_len
+
+    strings = [
+        'abc',
+        '',
+        'x' * pad_len + 'truncated',
+        u'caf\u00e9',
+        u'stra\u00dfe',
+        u'na\u00efve \u4e2d\u6587',
+        u'emoji \U0001F600 ok',
+        u'\U0001D400\U0001D401 bold',
+        'tab\tnewline\n?~',
+    ]
+
+    with tf_mod.graph.as_default():
+        in_layer = tf.placeholder("string", shape=[None,])
+        py_layer = tf_mod.make_string_encode_layer(in_layer, in_graph=False)
+        tf_layer = tf_mod.make_string_encode_layer(in_layer, in_graph=True)
+
+    py_ints, tf_ints = ff_model.sess.run(
+        [py_layer, tf_layer],
+        feed_dict={in_layer: np.array([in_string.encode('utf-8') for in_string in strings])}
+    )
+
+    assert tf_ints.shape == (len(strings), pad_len)
+    assert (tf_ints == py_ints).all()
+    assert (tf_ints == tf_mod.text_map.strings_to_array(strings)).all()
+
+    # every encoder shares one copy of the lookup table
+    table_consts = [
+        op for op in tf_mod.graph.get_operations()
+        if op.type == 'Const' and op.name.startswith('codepoint_table/')
+    ]
+    assert len(table_consts) == 3
+
+    # padding and truncation
+    assert (tf_ints[1] == tf_mod.text_map.pad_char_idx).all()
+    assert tf_mod.text_map.ints_to_string(tf_ints[2]).endswith('truncated')
+
+
 def test_text_ff():
     """Test dense feedforward model"""
 